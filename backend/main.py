@@ -1,25 +1,38 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Header, Request
 from google import genai
 from google.genai import types
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 import os
 from dotenv import load_dotenv
 from pathlib import Path
 import base64
+import json
+import re
+import hashlib
+import threading
 import io
 from PIL import Image, ImageDraw, ImageFont
 import time
+import asyncio
+import multiprocessing
 import tempfile
-from moviepy.editor import VideoFileClip, ImageClip, CompositeVideoClip
 import traceback
-from typing import List, Dict, Optional
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from collections import OrderedDict, deque
+from typing import Callable, List, Dict, Optional
 from supabase import create_client, Client
 from pydantic import BaseModel
-import stripe
-
-# Patch para compatibilidade de imagem
-if not hasattr(Image, 'ANTIALIAS'):
-    Image.ANTIALIAS = Image.Resampling.LANCZOS
+import httpx
+import media
+import metrics
+import resilience
+from media import (InputImageError, apply_video_watermark, normalize_input_image, render_output_set,
+                   video_poster, video_preview, video_rendition, LADDER_BITRATES)
 
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path)
@@ -27,100 +40,1214 @@ load_dotenv(dotenv_path=env_path)
 # Configurações
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 api_key = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=api_key)
-
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
-stripe.api_key = STRIPE_API_KEY
 
-app = FastAPI()
+# Clientes criados no lifespan (não no import) para o cold start não pagar por eles;
+# o stripe só é importado quando o webhook chega. Orçamento medido por startup_bench.py.
+supabase: Optional[Client] = None
+client: Optional[genai.Client] = None
+
+def build_clients():
+    global supabase, client
+    if supabase is None: supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    if client is None: client = genai.Client(api_key=api_key)
+
+# --- MÉTRICAS (GET /metrics, formato Prometheus) ---
+# Cada etapa das rotas vira uma série do histograma nastia_stage_seconds{route,stage};
+# etapas marcadas com `upstream` contam falhas em nastia_upstream_errors_total.
+STAGE_SECONDS = metrics.Histogram("nastia_stage_seconds", "Duração de cada etapa das rotas", ["route", "stage"])
+REQUEST_SECONDS = metrics.Histogram("nastia_request_seconds", "Duração total das requisições", ["route", "method", "status"])
+UPSTREAM_ERRORS = metrics.Counter("nastia_upstream_errors_total", "Falhas em chamadas a serviços externos", ["upstream", "stage"])
+BYTES = metrics.Counter("nastia_bytes_total", "Bytes transferidos", ["direction", "peer"])
+MODEL_WAITING = metrics.Gauge("nastia_model_waiting", "Chamadas esperando vaga no limite do modelo", ["model"])
+MODEL_INFLIGHT = metrics.Gauge("nastia_model_inflight", "Chamadas em andamento por modelo", ["model"])
+QUEUE_WAIT_SECONDS = metrics.Histogram("nastia_queue_wait_seconds", "Espera por vaga no modelo, por plano", ["model", "plan"])
+IDEMPOTENT_REPLAYS = metrics.Counter("nastia_idempotent_replays_total", "Repetições respondidas pela chave de idempotência", ["route", "state"])
+RATE_LIMITED = metrics.Counter("nastia_rate_limited_total", "Requisições recusadas pelo limite de taxa", ["rule"])
+ADMISSION_REJECTED = metrics.Counter("nastia_admission_rejected_total", "Requisições recusadas com 429 por fila cheia", ["model"])
+MEDIA_TASK_SECONDS = metrics.Histogram("nastia_media_task_seconds", "Tempo de CPU das tarefas no pool de mídia", ["task"])
+MEDIA_WAIT_SECONDS = metrics.Histogram("nastia_media_wait_seconds", "Espera por vaga no pool de mídia", ["task"])
+VEO_POLLS = metrics.Counter("nastia_veo_polls_total", "Consultas de operação feitas pelo poller do Veo")
+
+def queue_depths():
+    return [({"queue": "media_waiting"}, media_workers.queued - media_workers.in_pool),
+            ({"queue": "media_running"}, media_workers.in_pool),
+            ({"queue": "veo_pending"}, len(veo_poller.pending)),
+            ({"queue": "history_rows"}, len(history_writer.rows)),
+            ({"queue": "background_tasks"}, len(_job_tasks))]
+
+def job_counts():
+    counts: Dict[str, int] = {}
+    for job in list(jobs.values()): counts[job["status"]] = counts.get(job["status"], 0) + 1
+    return [({"status": status}, n) for status, n in counts.items()]
+
+def admitted_counts():
+    return [({"model": gate.model}, gate.admitted) for gate in list(_model_gates.values())]
+
+def lane_depths():
+    return [({"model": gate.model, "plan": plan}, sum(len(q) for q in users.values()))
+            for gate in list(_model_gates.values()) for plan, users in list(gate.lanes.items())]
+
+LANE_WAITING = metrics.Gauge("nastia_lane_waiting", "Chamadas na fila de prioridade por modelo e plano", ["model", "plan"], fn=lane_depths)
+MODEL_ADMITTED = metrics.Gauge("nastia_model_admitted", "Requisições admitidas (na fila ou rodando) por modelo", ["model"], fn=admitted_counts)
+QUEUE_DEPTH = metrics.Gauge("nastia_queue_depth", "Itens em cada fila interna", ["queue"], fn=queue_depths)
+JOBS = metrics.Gauge("nastia_jobs", "Jobs de vídeo em memória por status", ["status"], fn=job_counts)
+
+@contextmanager
+def stage(route: str, name: str, upstream: Optional[str] = None):
+    t0 = time.perf_counter()
+    try:
+        yield
+    except HTTPException:
+        raise
+    except Exception:
+        if upstream: UPSTREAM_ERRORS.inc(upstream=upstream, stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, route=route, stage=name)
+
+# Concorrência e admissão por modelo. Cada modelo tem MODEL_CONCURRENCY chamadas
+# simultâneas e uma fila de espera de MODEL_QUEUE lugares. As rotas que chamam modelo
+# passam pelo AdmissionMiddleware: com a fila cheia a resposta é 429 + Retry-After
+# antes de ler o corpo e de reservar créditos.
+# Quem espera vaga entra numa fila por plano ("Prioridade na Fila"): as raias são servidas
+# por peso (fila justa ponderada, então o free anda mais devagar mas nunca para) e, dentro
+# de cada raia, em rodízio por usuário, para que uma rajada de um só não trave os outros.
+IMAGE_MODEL = "gemini-2.5-flash-image"
+VIDEO_MODEL = "veo-3.1-generate-preview"
+
+def env_map(name: str, cast=int) -> dict:
+    return {k.strip(): cast(v) for k, v in (item.split("=") for item in os.getenv(name, "").split(",") if "=" in item)}
+
+MODEL_CONCURRENCY_DEFAULT = int(os.getenv("MODEL_CONCURRENCY_DEFAULT", "16"))
+MODEL_CONCURRENCY = env_map("MODEL_CONCURRENCY")
+MODEL_QUEUE_DEFAULT = int(os.getenv("MODEL_QUEUE_DEFAULT", "32"))
+MODEL_QUEUE = env_map("MODEL_QUEUE")
+MODEL_SERVICE_TIME_DEFAULT = float(os.getenv("MODEL_SERVICE_TIME_DEFAULT", "10"))
+MODEL_SERVICE_TIME = env_map("MODEL_SERVICE_TIME", float)
+RETRY_AFTER_MAX = int(os.getenv("RETRY_AFTER_MAX", "120"))
+PLAN_WEIGHTS = {"free": 1, "plus": 2, "criação": 2, "pro": 4, "agency": 8, **env_map("PLAN_WEIGHTS", float)}
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "32"))
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="nastia")
+
+class ModelGate:
+    def __init__(self, model: str):
+        self.model = model
+        self.limit = MODEL_CONCURRENCY.get(model, MODEL_CONCURRENCY_DEFAULT)
+        self.queue_max = MODEL_QUEUE.get(model, MODEL_QUEUE_DEFAULT)
+        self.free = self.limit
+        self.admitted = 0  # requisições aceitas pelo middleware (ou jobs em fila) ainda em andamento
+        self.running = 0
+        self.service_time = MODEL_SERVICE_TIME.get(model, MODEL_SERVICE_TIME_DEFAULT)  # média móvel (s)
+        self.lanes: Dict[str, "OrderedDict[str, deque]"] = {}  # plano -> usuário -> waiters
+        self.passes: Dict[str, float] = {}  # tempo virtual de cada raia
+        self.vtime = 0.0
+
+    def admit(self) -> bool:
+        if self.admitted >= self.limit + self.queue_max: return False
+        self.admitted += 1
+        return True
+
+    def leave(self):
+        self.admitted -= 1
+
+    def hold(self):
+        """Job que continua na fila depois da resposta: ocupa um lugar até sair (leave)."""
+        self.admitted += 1
+
+    def waiting(self) -> int:
+        return sum(len(q) for users in self.lanes.values() for q in users.values())
+
+    def pop(self, lanes: dict, passes: dict):
+        """Próximo waiter: raia de menor tempo virtual, depois o primeiro usuário da vez."""
+        active = [plan for plan, users in lanes.items() if users]
+        if not active: return None, None
+        plan = min(active, key=lambda p: (passes[p], -PLAN_WEIGHTS.get(p, 1)))
+        start = passes[plan]
+        passes[plan] += 1 / PLAN_WEIGHTS.get(plan, 1)
+        users = lanes[plan]
+        user = next(iter(users))
+        queue = users.pop(user)
+        waiter = queue.popleft()
+        if queue: users[user] = queue  # volta para o fim do rodízio
+        return waiter, start
+
+    def try_acquire(self) -> bool:
+        if self.free > 0 and not self.waiting():
+            self.free -= 1
+            return True
+        return False
+
+    async def acquire(self, plan: str, user: Optional[str], ticket: Optional[dict] = None):
+        if self.try_acquire(): return
+        plan = plan if plan in PLAN_WEIGHTS else "free"
+        users = self.lanes.setdefault(plan, OrderedDict())
+        # Raia que volta a ter fila não acumula crédito do tempo em que ficou vazia
+        if not users: self.passes[plan] = max(self.passes.get(plan, 0.0), self.vtime)
+        waiter = {"future": asyncio.get_running_loop().create_future(), "ticket": ticket}
+        users.setdefault(user or "", deque()).append(waiter)
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                self.release()  # a vaga chegou junto com o cancelamento: repassa
+            else:
+                queue = users.get(user or "")
+                if queue and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue: users.pop(user or "")
+            raise
+
+    def release(self):
+        while True:
+            waiter, start = self.pop(self.lanes, self.passes)
+            if waiter is None:
+                self.free += 1
+                return
+            # Waiter cancelado que ainda não saiu da fila (a tarefa não voltou a rodar): pula
+            if waiter["future"].done(): continue
+            self.vtime = start
+            waiter["future"].set_result(None)
+            return
+
+    def position(self, ticket: dict) -> Optional[int]:
+        """Posição (1 = próximo) simulando a ordem de atendimento sobre uma cópia das filas."""
+        lanes = {plan: OrderedDict((u, deque(q)) for u, q in users.items()) for plan, users in self.lanes.items()}
+        passes = dict(self.passes)
+        n = 0
+        while True:
+            waiter, _ = self.pop(lanes, passes)
+            if waiter is None: return None
+            n += 1
+            if waiter["ticket"] is ticket: return n
+
+    def observe(self, elapsed: float):
+        self.service_time += 0.2 * (elapsed - self.service_time)
+
+    def retry_after(self) -> int:
+        """Segundos até a fila atual escoar o bastante para uma nova chamada começar."""
+        waiting = max(self.admitted - self.running, 0)
+        return min(RETRY_AFTER_MAX, max(1, int((waiting + 1) / self.limit * self.service_time + 0.999)))
+
+    def overloaded(self) -> HTTPException:
+        return HTTPException(429, "Muitas requisições em andamento. Tente novamente em instantes.",
+                             headers={"Retry-After": str(self.retry_after())})
+
+_model_gates: Dict[str, ModelGate] = {}
+
+def model_gate(model: str) -> ModelGate:
+    if model not in _model_gates: _model_gates[model] = ModelGate(model)
+    return _model_gates[model]
+
+async def take_slot(model: str, plan: str = "free", user: Optional[str] = None, ticket: Optional[dict] = None,
+                    timeout: Optional[float] = None) -> float:
+    """Espera a vez no modelo; devolve o instante de início, que vai para give_slot."""
+    gate = model_gate(model)
+    MODEL_WAITING.inc(model=model)
+    t0 = time.perf_counter()
+    try:
+        await asyncio.wait_for(gate.acquire(plan, user, ticket), timeout)
+    finally:
+        MODEL_WAITING.dec(model=model)
+    QUEUE_WAIT_SECONDS.observe(time.perf_counter() - t0, model=model, plan=plan)
+    MODEL_INFLIGHT.inc(model=model)
+    gate.running += 1
+    return time.perf_counter()
+
+def give_slot(model: str, started: float):
+    gate = model_gate(model)
+    gate.observe(time.perf_counter() - started)
+    gate.running -= 1
+    MODEL_INFLIGHT.dec(model=model)
+    gate.release()
+
+@asynccontextmanager
+async def model_slot(model: str, plan: str = "free", user: Optional[str] = None, ticket: Optional[dict] = None,
+                     timeout: Optional[float] = None):
+    started = await take_slot(model, plan, user, ticket, timeout)
+    try:
+        yield
+    finally:
+        give_slot(model, started)
+
+def spare_slot_call(model: str, factory) -> Optional[asyncio.Task]:
+    """Chamada extra (hedge) numa vaga livre do modelo, sem esperar nem furar a fila; None se não há vaga."""
+    gate = model_gate(model)
+    if not gate.try_acquire(): return None
+    MODEL_INFLIGHT.inc(model=model)
+    gate.running += 1
+    def done(_):
+        # Callback e não finally: roda mesmo se a tarefa for cancelada antes de começar
+        gate.running -= 1
+        MODEL_INFLIGHT.dec(model=model)
+        gate.release()
+    task = asyncio.ensure_future(factory())
+    task.add_done_callback(done)
+    return task
+
+def is_quota_error(e: Exception) -> bool:
+    return getattr(e, "code", None) == 429
+
+# Circuit breakers por dependência (estado em /metrics). Toda chamada externa passa por
+# resilience.call_async/call_sync: falhas transitórias são repetidas com backoff e jitter
+# e, depois de várias seguidas, o circuito abre e as chamadas falham na hora (503).
+# Modelos têm um breaker cada (queda do modelo de imagem não derruba o chat) e o 429
+# de cota não é repetido: vira 429 com Retry-After para o cliente (upstream_failure).
+_model_breakers: Dict[str, resilience.CircuitBreaker] = {}
+
+def model_breaker(model: str) -> resilience.CircuitBreaker:
+    if model not in _model_breakers: _model_breakers[model] = resilience.CircuitBreaker(model, retry_quota=False)
+    return _model_breakers[model]
+
+SUPABASE = resilience.CircuitBreaker("supabase")
+
+def supabase_call(fn, idempotent: bool = True, attempts: int = resilience.RETRY_ATTEMPTS):
+    return resilience.call_sync(SUPABASE, fn, idempotent, attempts)
+
+def upstream_failure(e: Exception, model: str) -> Optional[HTTPException]:
+    """Resposta para falhas de capacidade: circuito aberto (503) ou cota do modelo (429)."""
+    if isinstance(e, resilience.CircuitOpen):
+        return HTTPException(503, str(e), headers={"Retry-After": str(int(e.retry_after + 0.999))})
+    if is_quota_error(e): return model_gate(model).overloaded()
+    return None
+
+async def run_sync(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args, **kwargs))
+
+# --- POOL DE MÍDIA (processos separados para PIL/JPEG/ffmpeg) ---
+# Trabalho pesado em CPU sai do processo que atende as requisições. A fila é limitada:
+# acima de MEDIA_QUEUE_MAX tarefas a submissão espera, em vez de acumular memória.
+# Os processos nascem do forkserver (spawn no Windows), nunca de fork do processo do
+# uvicorn, que tem threads e locks que o filho herdaria travados.
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(os.cpu_count() or 2)))
+MEDIA_QUEUE_MAX = int(os.getenv("MEDIA_QUEUE_MAX", str(MEDIA_WORKERS * 4)))
+
+class MediaWorkers:
+    def __init__(self):
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.closed = False
+        self.queued = 0
+        self.in_pool = 0
+        self.stats: Dict[str, dict] = {}
+
+    def record(self, name: str, wait: float, elapsed: float):
+        st = self.stats.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0, "wait_total_s": 0.0})
+        st["count"] += 1; st["total_s"] += elapsed; st["wait_total_s"] += wait
+        st["max_s"] = max(st["max_s"], elapsed)
+        MEDIA_TASK_SECONDS.observe(elapsed, task=name)
+        MEDIA_WAIT_SECONDS.observe(wait, task=name)
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        if self.closed: raise RuntimeError("Pool de mídia encerrado.")
+        if self.pool is None:
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            if ctx.get_start_method() == "forkserver": ctx.set_forkserver_preload(["media"])
+            self.pool = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, mp_context=ctx)
+        return self.pool
+
+    async def submit(self, fn, *args):
+        self.get_pool()
+        if self.slots is None: self.slots = asyncio.Semaphore(MEDIA_QUEUE_MAX)
+        t0 = time.perf_counter()
+        self.queued += 1
+        try:
+            async with self.slots:
+                self.in_pool += 1
+                pool = self.get_pool()
+                try:
+                    result, elapsed = await asyncio.get_running_loop().run_in_executor(pool, media.timed, fn, *args)
+                except BrokenProcessPool:
+                    # Um processo morreu (ex.: OOM killer num decode enorme): o pool não se recupera
+                    # sozinho, então é trocado por um novo; quem estava nele falha com este erro.
+                    if self.pool is pool:
+                        print(f"Pool de mídia quebrado em {fn.__name__}; recriando")
+                        self.pool = None
+                        pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+                finally:
+                    self.in_pool -= 1
+        finally:
+            self.queued -= 1
+        self.record(fn.__name__, time.perf_counter() - t0 - elapsed, elapsed)
+        return result
+
+    async def close(self):
+        # Espera (fora do loop) as tarefas em andamento; as que ainda não começaram são canceladas
+        self.closed = True
+        pool, self.pool = self.pool, None
+        if pool: await run_sync(pool.shutdown, wait=True, cancel_futures=True)
+
+    def snapshot(self) -> dict:
+        return {"workers": MEDIA_WORKERS, "queue_max": MEDIA_QUEUE_MAX, "waiting": self.queued - self.in_pool,
+                "in_pool": self.in_pool, "tasks": self.stats}
+
+media_workers = MediaWorkers()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    build_clients()
+    sweeper = asyncio.create_task(sweep_stale_reservations())
+    recovery = asyncio.create_task(watch_video_jobs()) if job_backend else None
+    history_writer.start()
+    yield
+    sweeper.cancel()
+    if recovery: recovery.cancel()
+    await drain_jobs(JOB_DRAIN_TIMEOUT)  # antes do histórico: as tarefas ainda gravam nele
+    await history_writer.close()
+    await media_workers.close()
+
+def admission_model(path: str) -> Optional[str]:
+    return {"/generate-image": IMAGE_MODEL, "/generate-video": VIDEO_MODEL, "/chat": CHAT_MODEL, "/chat/stream": CHAT_MODEL}.get(path)
+
+class AdmissionMiddleware:
+    """Recusa cedo (429) quando a fila do modelo da rota está cheia; o corpo nem chega a ser lido."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        model = admission_model(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if model is None: return await self.app(scope, receive, send)
+        gate = model_gate(model)
+        if not gate.admit():
+            ADMISSION_REJECTED.inc(model=model)
+            exc = gate.overloaded()
+            return await JSONResponse({"detail": exc.detail}, exc.status_code, headers=exc.headers)(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.leave()
+
+# --- LIMITE DE TAXA (token bucket por usuário e por IP) ---
+# Roda antes de ler o corpo e de qualquer consulta: o usuário vem do header X-User-Id e o
+# plano do cache preenchido por reserve_credits e user_plan (sem cache, vale o limite do free).
+# Limites em requisições por minuto, que também são o tamanho da rajada permitida.
+# Sem X-User-Id vale um balde anônimo (RATE_LIMIT_ANON) por IP e regra, mais apertado.
+# O IP é o de scope["client"]; atrás de proxy (Render, Railway...), RATE_LIMIT_TRUSTED_HOPS
+# diz quantos proxies confiáveis acrescentam ao X-Forwarded-For, e o IP é o que o
+# mais externo deles viu (um cliente não consegue forjar essa posição). Em produção atrás
+# de proxy ele é obrigatório (1 no Render/Railway): com 0, todos os clientes teriam o IP do
+# proxy e dividiriam os mesmos baldes. Chegando X-Forwarded-For com 0, o log avisa uma vez.
+# Toda rota limitada recebe user_id no corpo e recusa (403) um X-User-Id diferente: senão
+# bastaria trocar o header a cada requisição para cair sempre num balde novo. Um id que não
+# existe também não passa: as rotas de geração falham no reserve_credits e o chat no
+# user_plan (perfil lido do Supabase e guardado em _plan_cache), antes de chamar o modelo.
+RATE_LIMIT_ROUTES = {"/generate-image": "generate", "/generate-video": "generate", "/chat": "chat",
+                     "/chat/stream": "chat", "/track-referral": "referral"}
+RATE_LIMITS = {
+    "generate": {"free": 6, "plus": 12, "criação": 12, "pro": 30, "agency": 60, **env_map("RATE_LIMIT_GENERATE", float)},
+    "chat": {"free": 10, "plus": 20, "criação": 20, "pro": 40, "agency": 80, **env_map("RATE_LIMIT_CHAT", float)},
+    "referral": {"free": 5, **env_map("RATE_LIMIT_REFERRAL", float)},
+}
+RATE_LIMIT_ANON = {"generate": 2, "chat": 5, "referral": 2, **env_map("RATE_LIMIT_ANON", float)}
+RATE_LIMIT_IP = float(os.getenv("RATE_LIMIT_IP", "120"))
+RATE_LIMIT_TRUSTED_HOPS = int(os.getenv("RATE_LIMIT_TRUSTED_HOPS", "0"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_KEYS_MAX = int(os.getenv("RATE_LIMIT_KEYS_MAX", "100000"))
+_plan_cache: "OrderedDict[str, str]" = OrderedDict()
+_plan_lock = threading.Lock()
+
+def remember_plan(user_id: str, plan: str):
+    with _plan_lock:
+        _plan_cache[user_id] = plan
+        _plan_cache.move_to_end(user_id)
+        if len(_plan_cache) > RATE_LIMIT_KEYS_MAX: _plan_cache.popitem(last=False)
+
+class MemoryRateStore:
+    def __init__(self):
+        self.buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def take(self, key: str, per_minute: float) -> float:
+        """Consome um token; devolve 0 se passou ou os segundos até o próximo token."""
+        now, rate = time.monotonic(), per_minute / 60
+        tokens, last = self.buckets.pop(key, (per_minute, now))
+        tokens = min(per_minute, tokens + (now - last) * rate)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        self.buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+        if len(self.buckets) > RATE_LIMIT_KEYS_MAX: self.buckets.popitem(last=False)
+        return wait
+
+class SupabaseRateStore:
+    """Baldes compartilhados entre workers (backend/sql/rate_limits.sql)."""
+    async def take(self, key: str, per_minute: float) -> float:
+        res = await run_sync(supabase_call, lambda: supabase.rpc("rate_limit_take", {"p_key": key, "p_per_minute": per_minute}).execute(),
+                             False, 1)
+        return float(res.data or 0)
+
+class RateLimiter:
+    def __init__(self, store):
+        self.store = store
+        self.local = store if isinstance(store, MemoryRateStore) else MemoryRateStore()
+
+    async def take(self, key: str, per_minute: float) -> float:
+        try:
+            return await self.store.take(key, per_minute)
+        except Exception as e:
+            # Backend compartilhado fora do ar: segue limitando só neste processo
+            print(f"Erro Rate Limit: {e}")
+            return await self.local.take(key, per_minute)
+
+    async def check(self, rule: str, user: str, ip: str) -> float:
+        wait = await self.take(f"ip:{ip}", RATE_LIMIT_IP) if ip else 0.0
+        if wait: return wait
+        if not user: return await self.take(f"{rule}:anon:{ip}", RATE_LIMIT_ANON[rule])
+        limits = RATE_LIMITS[rule]
+        return await self.take(f"{rule}:{user}", limits.get(_plan_cache.get(user), limits["free"]))
+
+rate_limiter = RateLimiter(SupabaseRateStore() if RATE_LIMIT_BACKEND == "supabase" else MemoryRateStore())
+
+_proxy_warned = False
+
+def client_ip(scope, headers: dict) -> str:
+    global _proxy_warned
+    if RATE_LIMIT_TRUSTED_HOPS:
+        hops = [h.strip() for h in headers.get(b"x-forwarded-for", b"").decode("latin-1").split(",") if h.strip()]
+        if hops: return hops[-min(RATE_LIMIT_TRUSTED_HOPS, len(hops))]
+    elif b"x-forwarded-for" in headers and not _proxy_warned:
+        _proxy_warned = True
+        print("AVISO Rate Limit: requisição com X-Forwarded-For e RATE_LIMIT_TRUSTED_HOPS=0; "
+              "o limite por IP está usando o IP do proxy. Defina RATE_LIMIT_TRUSTED_HOPS.")
+    return scope["client"][0] if scope.get("client") else ""
+
+class RateLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        rule = RATE_LIMIT_ROUTES.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if rule is None: return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        user = headers.get(b"x-user-id", b"").decode("latin-1")[:64]
+        ip = client_ip(scope, headers)
+        wait = await rate_limiter.check(rule, user, ip)
+        if wait:
+            RATE_LIMITED.inc(rule=rule)
+            return await JSONResponse({"detail": "Muitas requisições. Aguarde um pouco e tente novamente."}, 429,
+                                      headers={"Retry-After": str(max(1, int(wait + 0.999)))})(scope, receive, send)
+        await self.app(scope, receive, send)
+
+def check_user_header(header: Optional[str], user_id: Optional[str]):
+    if header is not None and header != user_id:
+        raise HTTPException(403, "X-User-Id não confere com o user_id enviado.")
+
+def load_plan(user_id: str) -> Optional[str]:
+    """Plano do perfil (None se o usuário não existe); fica em _plan_cache para o limite de taxa."""
+    with _plan_lock: plan = _plan_cache.get(user_id)
+    if plan: return plan
+    res = supabase_call(supabase.table("profiles").select("plan_tier").eq("id", user_id).execute)
+    if not res.data: return None
+    plan = res.data[0].get("plan_tier") or "free"
+    remember_plan(user_id, plan)
+    return plan
+
+# --- IDEMPOTÊNCIA (header Idempotency-Key) ---
+# A primeira requisição com a chave roda; duplicatas simultâneas esperam o mesmo resultado
+# e as que chegam depois recebem a resposta guardada até IDEMPOTENCY_TTL. A chave vale por
+# rota + X-User-Id e fica presa ao corpo (sha256, sem o boundary do multipart): reusar a
+# chave com outro corpo dá 422. Falhas 5xx e 429 não ficam guardadas: um novo envio roda de novo.
+# IDEMPOTENCY_BACKEND=supabase compartilha as chaves entre workers (backend/sql/idempotency_keys.sql);
+# a duplicata que cai em outro worker enquanto a primeira roda recebe 409 com Retry-After.
+# Uma chave em andamento cujo worker morreu se libera após IDEMPOTENCY_LOCK s.
+# Fica por dentro do limite de taxa e da admissão (o corpo só é lido depois deles). O corpo
+# é hasheado enquanto chega e vai para um SpooledTemporaryFile (disco acima de 1 MB, como no
+# parser de multipart do Starlette), de onde é repassado à rota; corpos acima de
+# IDEMPOTENCY_BODY_MAX (padrão: MAX_INPUT_IMAGES fotos de INPUT_IMAGE_MAX) dão 413.
+MAX_INPUT_IMAGES = int(os.getenv("MAX_INPUT_IMAGES", "8"))
+INPUT_IMAGE_MAX = int(os.getenv("INPUT_IMAGE_MAX", str(50 * 1024 * 1024)))  # bytes por imagem enviada
+IDEMPOTENT_ROUTES = {"/generate-image", "/generate-video", "/redeem-coins", "/redeem-coupon"}
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX = int(os.getenv("IDEMPOTENCY_MAX", "10000"))
+IDEMPOTENCY_LOCK = int(os.getenv("IDEMPOTENCY_LOCK", "600"))
+IDEMPOTENCY_BODY_MAX = int(os.getenv("IDEMPOTENCY_BODY_MAX", str(MAX_INPUT_IMAGES * INPUT_IMAGE_MAX + 1024 * 1024)))
+IDEMPOTENCY_SPOOL_MEMORY = 1024 * 1024
+IDEMPOTENCY_CHUNK = 64 * 1024
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+REUSED_KEY = "Idempotency-Key já usada com outro corpo de requisição."
+
+class MemoryIdempotencyStore:
+    def __init__(self):
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+
+    def purge(self):
+        # Ordem de chegada ~ ordem de expiração: basta olhar o começo
+        now = time.time()
+        while self.entries:
+            head = next(iter(self.entries.values()))
+            if len(self.entries) <= IDEMPOTENCY_MAX and head["expires"] > now: break
+            self.entries.popitem(last=False)
+
+    async def claim(self, key: str, fingerprint: str) -> Optional[dict]:
+        """Reserva a chave; se ela já existe, devolve o registro ({"fingerprint", "response"})."""
+        self.purge()
+        if key in self.entries: return self.entries[key]
+        self.entries[key] = {"fingerprint": fingerprint, "response": None, "expires": time.time() + IDEMPOTENCY_LOCK}
+        return None
+
+    async def store(self, key: str, response: tuple):
+        self.entries[key].update(response=response, expires=time.time() + IDEMPOTENCY_TTL)
+
+    async def release(self, key: str):
+        self.entries.pop(key, None)
+
+class SupabaseIdempotencyStore:
+    """Chaves compartilhadas entre workers (backend/sql/idempotency_keys.sql)."""
+    async def claim(self, key: str, fingerprint: str) -> Optional[dict]:
+        res = await run_sync(supabase_call, lambda: supabase.rpc("idempotency_claim", {
+            "p_key": key, "p_fingerprint": fingerprint, "p_lock_seconds": IDEMPOTENCY_LOCK}).execute(), False)
+        if not res.data: return None
+        row, response = res.data[0], res.data[0]["o_response"]
+        if response:
+            response = (response["status"], [(k.encode("latin-1"), v.encode("latin-1")) for k, v in response["headers"]],
+                        base64.b64decode(response["body"]))
+        return {"fingerprint": row["o_fingerprint"], "response": response}
+
+    async def store(self, key: str, response: tuple):
+        status, headers, body = response
+        data = {"status": status, "headers": [(k.decode("latin-1"), v.decode("latin-1")) for k, v in headers],
+                "body": base64.b64encode(body).decode()}
+        expires = datetime.fromtimestamp(time.time() + IDEMPOTENCY_TTL, timezone.utc).isoformat()
+        await run_sync(supabase_call, supabase.table("idempotency_keys").update({"response": data, "expires_at": expires}).eq("key", key).execute)
+
+    async def release(self, key: str):
+        await run_sync(supabase_call, supabase.table("idempotency_keys").delete().eq("key", key).is_("response", "null").execute)
+
+idempotency_store = SupabaseIdempotencyStore() if IDEMPOTENCY_BACKEND == "supabase" else MemoryIdempotencyStore()
+
+class BodyFingerprint:
+    """sha256 do corpo sem o boundary do multipart, calculado pedaço a pedaço."""
+    def __init__(self, content_type: bytes):
+        self.hash = hashlib.sha256()
+        self.carry = b""  # fim do pedaço anterior, que pode ser o começo de um boundary
+        # O navegador sorteia um boundary novo a cada envio do mesmo formulário
+        self.boundary = content_type.split(b"boundary=", 1)[1].split(b";")[0].strip(b'"') if b"boundary=" in content_type else b""
+
+    def update(self, chunk: bytes):
+        if not self.boundary: return self.hash.update(chunk)
+        buf, start = self.carry + chunk, 0
+        while (i := buf.find(self.boundary, start)) != -1:
+            self.hash.update(buf[start:i])
+            start = i + len(self.boundary)
+        safe = max(start, len(buf) - len(self.boundary) + 1)
+        self.hash.update(buf[start:safe])
+        self.carry = buf[safe:]
+
+    def hexdigest(self) -> str:
+        self.hash.update(self.carry)
+        self.carry = b""
+        return self.hash.hexdigest()
+
+def body_fingerprint(content_type: bytes, body: bytes) -> str:
+    fingerprint = BodyFingerprint(content_type)
+    fingerprint.update(body)
+    return fingerprint.hexdigest()
+
+def json_tuple(status: int, detail: str, headers: Optional[list] = None) -> tuple:
+    return (status, [(b"content-type", b"application/json"), *(headers or [])], json.dumps({"detail": detail}).encode())
+
+class IdempotencyMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.in_flight: Dict[str, dict] = {}  # duplicatas neste worker esperam a primeira
+
+    async def respond(self, response: tuple, send, replayed: bool = False):
+        status, headers, body = response
+        if replayed: headers = headers + [(b"idempotent-replayed", b"true")]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def spool_body(self, receive, spool, content_type: bytes) -> Optional[tuple]:
+        """Grava o corpo no spool e devolve (fingerprint, tamanho), ou None se o cliente desconectou.
+        Para de ler ao passar de IDEMPOTENCY_BODY_MAX."""
+        fingerprint, size = BodyFingerprint(content_type), 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect": return None
+            chunk = message.get("body", b"")
+            fingerprint.update(chunk)
+            size += len(chunk)
+            if spool._rolled: await run_sync(spool.write, chunk)  # já está em disco: escrita fora do loop
+            else: spool.write(chunk)
+            if not message.get("more_body") or size > IDEMPOTENCY_BODY_MAX: return fingerprint.hexdigest(), size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in IDEMPOTENT_ROUTES:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        key = headers.get(b"idempotency-key", b"").decode("latin-1")
+        if not key: return await self.app(scope, receive, send)
+        if len(key) > 255:
+            return await JSONResponse({"detail": "Idempotency-Key inválida."}, 400)(scope, receive, send)
+        cache_key = f"{scope['path']}:{headers.get(b'x-user-id', b'').decode('latin-1')}:{key}"
+        with tempfile.SpooledTemporaryFile(max_size=IDEMPOTENCY_SPOOL_MEMORY) as spool:
+            body = await self.spool_body(receive, spool, headers.get(b"content-type", b""))
+            if body is None: return
+            fingerprint, size = body
+            if size > IDEMPOTENCY_BODY_MAX:
+                return await JSONResponse({"detail": "Requisição grande demais."}, 413)(scope, receive, send)
+            spool.seek(0)
+            await self.dedupe(scope, receive, send, cache_key, fingerprint, spool, size)
+
+    async def dedupe(self, scope, receive, send, cache_key: str, fingerprint: str, spool, size: int):
+        entry = self.in_flight.get(cache_key)
+        if entry:
+            if entry["fingerprint"] != fingerprint: return await self.respond(json_tuple(422, REUSED_KEY), send)
+            IDEMPOTENT_REPLAYS.inc(route=scope["path"], state="in_flight")
+            return await self.respond(await asyncio.shield(entry["future"]), send, replayed=True)
+        entry = self.in_flight[cache_key] = {"fingerprint": fingerprint, "future": asyncio.get_running_loop().create_future()}
+        response = json_tuple(500, "Erro interno.")
+        try:
+            response = await self.first(scope, receive, send, cache_key, fingerprint, spool, size)
+        finally:
+            del self.in_flight[cache_key]
+            entry["future"].set_result(response)
+
+    async def first(self, scope, receive, send, cache_key: str, fingerprint: str, spool, size: int) -> tuple:
+        """Primeira requisição com a chave neste worker; devolve a resposta que as duplicatas locais recebem."""
+        try:
+            record = await idempotency_store.claim(cache_key, fingerprint)
+        except Exception as e:
+            # Sem como saber se a chave já rodou: recusar é melhor que cobrar duas vezes
+            print(f"Erro Idempotência: {e}")
+            response = json_tuple(503, "Não foi possível verificar a Idempotency-Key. Tente novamente.", [(b"retry-after", b"1")])
+            await self.respond(response, send)
+            return response
+        if record:
+            if record["fingerprint"] != fingerprint: response = json_tuple(422, REUSED_KEY)
+            elif record["response"] is None: response = json_tuple(409, "Requisição com esta Idempotency-Key em andamento.", [(b"retry-after", b"1")])
+            else:
+                IDEMPOTENT_REPLAYS.inc(route=scope["path"], state="stored")
+                await self.respond(record["response"], send, replayed=True)
+                return record["response"]
+            await self.respond(response, send)
+            return response
+        captured = {"status": None, "headers": [], "body": []}
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                captured["status"], captured["headers"] = message["status"], list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                captured["body"].append(message.get("body", b""))
+            await send(message)
+        body_sent = False
+        async def replay_body():
+            nonlocal body_sent
+            if body_sent: return await receive()  # depois do corpo só resta o disconnect
+            chunk = await run_sync(spool.read, IDEMPOTENCY_CHUNK) if spool._rolled else spool.read(IDEMPOTENCY_CHUNK)
+            body_sent = spool.tell() >= size
+            return {"type": "http.request", "body": chunk, "more_body": not body_sent}
+        response = json_tuple(500, "Erro interno.")
+        try:
+            await self.app(scope, replay_body, capture)
+            if captured["status"] is not None: response = (captured["status"], captured["headers"], b"".join(captured["body"]))
+        finally:
+            try:
+                if response[0] < 500 and response[0] != 429: await idempotency_store.store(cache_key, response)
+                else: await idempotency_store.release(cache_key)
+            except Exception as e:
+                print(f"Erro Idempotência: {e}")
+        return response
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(IdempotencyMiddleware)  # por dentro: só lê o corpo de quem passou pelo limite e pela fila
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(RateLimitMiddleware)  # fica por fora: quem estoura o limite nem ocupa fila
+
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - t0, route=getattr(route, "path", "unmatched"),
+                                method=request.method, status=status)
+
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["Retry-After", "Idempotent-Replayed"],
 )
 
 # --- FUNÇÕES AUXILIARES ---
-def check_and_deduct_credits(user_id: str, cost: int):
-    response = supabase.table("profiles").select("credits, plan_tier").eq("id", user_id).execute()
-    if not response.data: raise Exception("Usuário não encontrado.")
-    user = response.data[0]
-    if user["credits"] < cost:
-        raise Exception(f"Saldo insuficiente. Necessário: {cost}. Atual: {user['credits']}")
-    supabase.table("profiles").update({"credits": user["credits"] - cost}).eq("id", user_id).execute()
-    return user["plan_tier"]
+# Ledger de créditos (backend/sql/credit_ledger.sql): reserva antes do modelo,
+# confirma depois do upload e estorna em qualquer falha. Uma RPC por passo.
+# Reservas abertas neste processo (fila, render, commit pendente) recebem heartbeat
+# a cada CREDIT_HEARTBEAT_INTERVAL; a varredura só estorna as que ficaram CREDIT_RESERVATION_TTL
+# sem heartbeat, ou seja, as de um processo que morreu. Commit que falhou fica pendente
+# (e com heartbeat) até a varredura conseguir confirmá-lo.
+CREDIT_RESERVATION_TTL = int(os.getenv("CREDIT_RESERVATION_TTL", "1800"))
+CREDIT_SWEEP_INTERVAL = int(os.getenv("CREDIT_SWEEP_INTERVAL", "300"))
+CREDIT_HEARTBEAT_INTERVAL = min(CREDIT_SWEEP_INTERVAL, CREDIT_RESERVATION_TTL // 3)
+_open_reservations: set = set()
+_pending_commits: set = set()
+_ledger_lock = threading.Lock()
+
+def reserve_credits(user_id: str, cost: int):
+    try:
+        # Não idempotente: só repete quando o pedido certamente não chegou ao banco
+        res = supabase_call(lambda: supabase.rpc("reserve_credits", {"p_user_id": user_id, "p_amount": cost}).execute(), idempotent=False)
+    except resilience.CircuitOpen:
+        raise
+    except Exception as e:
+        raise Exception(getattr(e, "message", None) or str(e))
+    row = res.data[0]
+    with _ledger_lock: _open_reservations.add(row["reservation_id"])
+    remember_plan(user_id, row["plan_tier"])
+    return row["reservation_id"], row["plan_tier"]
+
+def settle(reservation_id: str):
+    with _ledger_lock:
+        _open_reservations.discard(reservation_id)
+        _pending_commits.discard(reservation_id)
+
+def commit_credits(reservation_id: str) -> bool:
+    try:
+        res = supabase_call(lambda: supabase.rpc("commit_credits", {"p_reservation_id": reservation_id}).execute())
+    except Exception as e:
+        print(f"Erro Commit Créditos {reservation_id} (fica pendente): {e}")
+        with _ledger_lock: _pending_commits.add(reservation_id)
+        return False
+    if not res.data: print(f"Erro Commit Créditos {reservation_id}: reserva já não estava aberta")
+    settle(reservation_id)
+    return True
+
+def refund_credits(reservation_id: Optional[str]):
+    if not reservation_id: return
+    try:
+        supabase_call(lambda: supabase.rpc("refund_credits", {"p_reservation_id": reservation_id}).execute())
+    except Exception as e: print(f"Erro Estorno Créditos {reservation_id}: {e}")
+    settle(reservation_id)  # sem heartbeat, a varredura estorna o que a chamada não conseguiu
+
+def touch_reservations():
+    with _ledger_lock: ids = list(_open_reservations)
+    if ids: supabase_call(lambda: supabase.rpc("touch_reservations", {"p_ids": ids}).execute())
+
+def release_stale_reservations() -> int:
+    res = supabase_call(lambda: supabase.rpc("release_stale_reservations", {"p_max_age_seconds": CREDIT_RESERVATION_TTL}).execute())
+    return res.data or 0
+
+async def sweep_stale_reservations():
+    while True:
+        await asyncio.sleep(CREDIT_HEARTBEAT_INTERVAL)
+        with _ledger_lock: pending = list(_pending_commits)
+        for reservation_id in pending: await run_sync(commit_credits, reservation_id)
+        try:
+            await run_sync(touch_reservations)
+            released = await run_sync(release_stale_reservations)
+            if released: print(f"Reservas estornadas pela varredura: {released}")
+        except Exception as e: print(f"Erro Varredura Créditos: {e}")
+
+# Chaves endereçadas por conteúdo: bytes iguais caem no mesmo objeto, que nunca muda,
+# então pode ir com Cache-Control longo. Um LRU local lembra o que já está no bucket.
+UPLOAD_CACHE_CONTROL = os.getenv("UPLOAD_CACHE_CONTROL", "31536000")
+KNOWN_OBJECTS_MAX = int(os.getenv("KNOWN_OBJECTS_MAX", "20000"))
+_known_objects: "OrderedDict[str, None]" = OrderedDict()
+_known_lock = threading.Lock()
+
+def object_key(file_bytes: bytes, file_ext: str) -> str:
+    return f"{hashlib.blake2b(file_bytes, digest_size=16).hexdigest()}.{file_ext}"
+
+def public_object_url(key: str) -> str:
+    return f"{SUPABASE_URL}/storage/v1/object/public/gallery/{key}"
+
+def remember_object(key: str) -> bool:
+    """Marca a chave como existente; devolve True se ela já era conhecida."""
+    with _known_lock:
+        if key in _known_objects:
+            _known_objects.move_to_end(key)
+            return True
+        _known_objects[key] = None
+        if len(_known_objects) > KNOWN_OBJECTS_MAX: _known_objects.popitem(last=False)
+        return False
+
+def upload_object(key: str, file_bytes: bytes, content_type: str):
+    with _known_lock:
+        if key in _known_objects: return
+    try:
+        supabase_call(lambda: supabase.storage.from_("gallery").upload(
+            key, file_bytes, {"content-type": content_type, "cache-control": UPLOAD_CACHE_CONTROL}))
+        BYTES.inc(len(file_bytes), direction="out", peer="supabase")
+    except Exception as e:
+        # Objeto já existe no bucket (mesmo conteúdo): nada a enviar
+        if not any(tag in str(e) for tag in ("Duplicate", "already exists")): raise
+    remember_object(key)
+
+# --- ARQUIVOS GRANDES (vídeo): download em blocos e upload resumível (TUS) ---
+# O vídeo nunca fica inteiro na memória: vai do Veo para um arquivo temporário,
+# o ffmpeg trabalha arquivo a arquivo e o upload sobe em blocos de 6 MB.
+STREAM_CHUNK = 1024 * 1024
+TUS_CHUNK = 6 * 1024 * 1024  # tamanho exigido pelo endpoint resumível do Supabase
+TUS_RETRIES = int(os.getenv("TUS_RETRIES", "5"))
+VIDEO_DOWNLOAD_TIMEOUT = float(os.getenv("VIDEO_DOWNLOAD_TIMEOUT", "120"))
+
+def download_video(video) -> str:
+    fd, path = tempfile.mkstemp(suffix=".mp4")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if video.video_bytes:
+                f.write(video.video_bytes)
+            else:
+                with httpx.stream("GET", video.uri, headers={"x-goog-api-key": api_key},
+                                  follow_redirects=True, timeout=VIDEO_DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_bytes(STREAM_CHUNK): f.write(chunk)
+    except Exception:
+        remove_files([path])
+        raise
+    BYTES.inc(os.path.getsize(path), direction="in", peer="veo")
+    return path
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            if path and os.path.exists(path): os.remove(path)
+        except OSError as e: print(f"Erro Limpeza {path}: {e}")
+
+def file_key(path: str, file_ext: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b""): h.update(chunk)
+    return f"{h.hexdigest()}.{file_ext}"
+
+def tus_upload(key: str, path: str, content_type: str):
+    headers = {"authorization": f"Bearer {SUPABASE_KEY}", "apikey": SUPABASE_KEY, "tus-resumable": "1.0.0"}
+    meta = {"bucketName": "gallery", "objectName": key, "contentType": content_type, "cacheControl": UPLOAD_CACHE_CONTROL}
+    size = os.path.getsize(path)
+    with httpx.Client(timeout=VIDEO_DOWNLOAD_TIMEOUT) as http:
+        r = http.post(f"{SUPABASE_URL}/storage/v1/upload/resumable", headers={
+            **headers, "upload-length": str(size),
+            "upload-metadata": ",".join(f"{k} {base64.b64encode(v.encode()).decode()}" for k, v in meta.items())})
+        if r.status_code == 409: return  # mesmo conteúdo já está no bucket
+        r.raise_for_status()
+        location = r.headers["location"]
+        offset, failures = 0, 0
+        with open(path, "rb") as f:
+            while offset < size:
+                f.seek(offset)
+                try:
+                    r = http.patch(location, content=f.read(TUS_CHUNK), headers={
+                        **headers, "upload-offset": str(offset), "content-type": "application/offset+octet-stream"})
+                    r.raise_for_status()
+                    offset = int(r.headers["upload-offset"])
+                except httpx.HTTPError as e:
+                    failures += 1
+                    if failures > TUS_RETRIES: raise
+                    print(f"Upload {key}: retomando após erro ({e})")
+                    time.sleep(min(2 ** failures, 30))
+                    offset = int(http.head(location, headers=headers).headers["upload-offset"])
+    BYTES.inc(size, direction="out", peer="supabase")
+
+def upload_file(path: str, file_ext: str, content_type: str) -> str:
+    """Como upload_to_supabase, mas lendo do disco em blocos (chave pelo hash do arquivo)."""
+    try:
+        key = file_key(path, file_ext)
+        if not remember_object(key):
+            try:
+                supabase_call(partial(tus_upload, key, path, content_type))
+            except Exception:
+                with _known_lock: _known_objects.pop(key, None)
+                raise
+        return public_object_url(key)
+    except Exception as e:
+        print(f"Erro Upload Supabase: {e}")
+        return ""
+
+# --- CACHE DE ASSETS RECENTES (fonte das edições sem ida e volta pelo navegador) ---
+HOT_ASSET_CACHE_MB = int(os.getenv("HOT_ASSET_CACHE_MB", "256"))
+
+class AssetCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.items: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None: self.items.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes: return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None: self.size -= len(old)
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+hot_assets = AssetCache(HOT_ASSET_CACHE_MB * 1024 * 1024)
+
+def load_source_asset(user_id: str, source_generation_id: Optional[str], source_key: Optional[str]) -> bytes:
+    """Bytes de uma geração anterior: cache local primeiro, depois o bucket."""
+    if source_generation_id:
+        res = supabase_call(supabase.table("generations").select("url, user_id").eq("id", source_generation_id).execute)
+        if not res.data or res.data[0]["user_id"] != user_id:
+            raise HTTPException(404, "Imagem de origem não encontrada.")
+        source_key = res.data[0]["url"].rsplit("/", 1)[-1]
+    if not source_key or not re.fullmatch(r"[A-Za-z0-9_-]+\.[a-z0-9]+", source_key):
+        raise HTTPException(400, "Imagem de origem inválida.")
+    data = hot_assets.get(source_key)
+    if data is None:
+        try:
+            data = supabase_call(partial(supabase.storage.from_("gallery").download, source_key))
+        except Exception as e:
+            if is_outage(e): raise
+            raise HTTPException(404, "Imagem de origem não encontrada.")  # objeto apagado ou chave de outro bucket
+        BYTES.inc(len(data), direction="in", peer="supabase")
+        hot_assets.put(source_key, data)
+    return data
 
 def upload_to_supabase(file_bytes: bytes, file_ext: str, content_type: str) -> str:
-    filename = f"{int(time.time())}_{os.urandom(4).hex()}.{file_ext}"
+    key = object_key(file_bytes, file_ext)
     try:
-        supabase.storage.from_("gallery").upload(filename, file_bytes, {"content-type": content_type})
-        return f"{SUPABASE_URL}/storage/v1/object/public/gallery/{filename}"
+        upload_object(key, file_bytes, content_type)
+        return public_object_url(key)
     except Exception as e:
         print(f"Erro Upload Supabase: {e}")
         return ""
 
-def save_to_history(user_id: str, type: str, url: str, prompt: str):
+# --- HISTÓRICO EM LOTE (gravação em background com spool local) ---
+# As linhas de `generations` vão para um buffer e são inseridas em lote a cada
+# HISTORY_BATCH_SIZE linhas ou HISTORY_FLUSH_MS ms. Até o insert confirmar, ficam
+# também no arquivo de spool, que é relido no startup se o processo cair.
+# Cada worker tem o próprio spool (history_spool.<pid>.jsonl) travado com flock enquanto
+# vive; no startup o worker adota os spools cujo dono morreu (trava livre) e o spool
+# antigo compartilhado (por rename), então nada é reenviado em duplicata.
+# Lote recusado pelo banco (não é queda) é refeito linha a linha: a linha que falhar vai
+# sem as colunas extras (migração ainda não aplicada) e, se ainda falhar, para o
+# dead-letter, sem travar as seguintes. Acima de HISTORY_MAX_ROWS pendentes (Supabase
+# fora do ar por muito tempo) as mais antigas também vão para o dead-letter.
+# Colunas que chegam depois da linha (derivados do vídeo) viram um update por url,
+# aplicado só depois que o insert dela confirmou.
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "50"))
+HISTORY_FLUSH_MS = int(os.getenv("HISTORY_FLUSH_MS", "500"))
+HISTORY_RETRIES = int(os.getenv("HISTORY_RETRIES", "3"))
+HISTORY_MAX_ROWS = int(os.getenv("HISTORY_MAX_ROWS", "10000"))
+HISTORY_SPOOL = Path(os.getenv("HISTORY_SPOOL", str(Path(__file__).parent / "history_spool.jsonl")))
+HISTORY_DEAD_LETTER = Path(os.getenv("HISTORY_DEAD_LETTER", str(Path(__file__).parent / "history_dead_letter.jsonl")))
+HISTORY_BASE_COLUMNS = ("user_id", "type", "url", "prompt", "created_at")
+
+def insert_history(rows: List[dict]):
+    # O HistoryWriter já repete com o spool como garantia; aqui só passa pelo breaker
+    supabase_call(supabase.table("generations").insert(rows).execute, idempotent=False, attempts=1)
+
+def update_history(url: str, fields: dict):
+    supabase_call(supabase.table("generations").update(fields).eq("url", url).execute)
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem flock, cada worker só relê o próprio spool
+    fcntl = None
+
+def lock_file(path: Path):
+    """Trava exclusiva sem bloquear; None se outro processo vivo já tem a trava."""
+    f = open(path, "a")
     try:
-        supabase.table("generations").insert({"user_id": user_id, "type": type, "url": url, "prompt": prompt}).execute()
-    except: pass
-
-def apply_watermark(img: Image.Image, plan: str) -> Image.Image:
-    # PLANOS PAGOS NÃO TEM MARCA D'ÁGUA
-    if plan in ["plus", "pro", "agency", "criação"]: return img.convert("RGB")
-    
-    base = img.convert("RGBA")
-    w, h = base.size
-    logo_path = Path(__file__).parent / "logo.png"
-    
-    if logo_path.exists():
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+def read_spool(path: Path) -> List[dict]:
+    rows = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    if line.strip(): rows.append(json.loads(line))
+                except ValueError:
+                    print(f"Erro Histórico: linha corrompida em {path.name}")  # escrita cortada na queda
+    except FileNotFoundError:
+        pass
+    return rows
+
+def is_outage(e: Exception) -> bool:
+    return isinstance(e, resilience.CircuitOpen) or resilience.is_retryable(e, True)
+
+class HistoryWriter:
+    def __init__(self, spool: Path):
+        self.base = spool
+        self.spool = self.worker_spool()
+        self.lock = None
+        self.rows: List[dict] = []
+        self.amends: Dict[str, dict] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+
+    def worker_spool(self) -> Path:
+        return self.base.with_name(f"{self.base.stem}.{os.getpid()}{self.base.suffix}")
+
+    def start(self):
+        self.spool = self.worker_spool()  # o pid do worker, não o do processo que importou o app
+        if fcntl: self.lock = lock_file(self.spool.with_suffix(".lock"))
+        # O glob também encontra o próprio spool (pid reaproveitado): ele só pode ser lido uma vez
+        others = sorted(p for p in self.base.parent.glob(f"{self.base.stem}.*{self.base.suffix}") if p != self.spool)
+        for path in [self.spool, self.base, *others]:
+            self.rows += self.claim(path)
+        if self.rows:
+            print(f"Histórico: {len(self.rows)} linhas recuperadas do spool")
+            self.rewrite_spool()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def claim(self, path: Path) -> List[dict]:
+        """Linhas de um spool órfão, que passa a ser deste worker."""
+        if path == self.spool:
+            return read_spool(path)  # pid reaproveitado: o spool é de um processo anterior deste worker
+        if path == self.base:
+            claimed = path.with_name(f"{path.name}.{os.getpid()}.claimed")
+            try:
+                os.rename(path, claimed)  # só um worker ganha o rename
+            except FileNotFoundError:
+                return []
+            rows = read_spool(claimed)
+            claimed.unlink()
+            return rows
+        if fcntl is None: return []
+        lock = lock_file(path.with_suffix(".lock"))
+        if lock is None: return []  # dono vivo
         try:
-            logo = Image.open(logo_path).convert("RGBA")
-            lw = int(w * 0.12)
-            ar = logo.width / logo.height
-            lh = int(lw / ar)
-            logo = logo.resize((lw, lh), Image.Resampling.LANCZOS)
-            base.paste(logo, (w - lw - int(w*0.03), h - lh - int(w*0.03)), logo)
-        except: pass
-    return base.convert("RGB")
-
-def apply_video_watermark(v_bytes: bytes, plan: str) -> bytes:
-    if plan in ["plus", "pro", "agency", "criação"]: return v_bytes
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
-        tmp.write(v_bytes)
-        path = tmp.name
-    out = path.replace(".mp4", "_wm.mp4")
-    lp = Path(__file__).parent / "logo.png"
-    
+            rows = read_spool(path)
+            path.unlink(missing_ok=True)
+            path.with_suffix(".lock").unlink(missing_ok=True)
+            return rows
+        finally:
+            lock.close()
+
+    def add(self, row: dict):
+        self.rows.append(row)
+        with open(self.spool, "a", encoding="utf-8") as f: f.write(json.dumps(row) + "\n")
+        if len(self.rows) > HISTORY_MAX_ROWS:
+            overflow = self.rows[:len(self.rows) - HISTORY_MAX_ROWS]
+            del self.rows[:len(overflow)]
+            self.dead_letter(overflow, "fila cheia")
+            self.rewrite_spool()
+        if self.wakeup and len(self.rows) >= HISTORY_BATCH_SIZE: self.wakeup.set()
+
+    def amend(self, url: str, fields: dict):
+        self.amends.setdefault(url, {}).update(fields)
+        if self.wakeup: self.wakeup.set()
+
+    async def apply_amends(self) -> bool:
+        pending = {row.get("url") for row in self.rows}
+        for url in [u for u in self.amends if u not in pending]:
+            try:
+                with stage("history", "update", upstream="supabase"): await run_sync(update_history, url, self.amends[url])
+            except Exception as e:
+                print(f"Erro Histórico (update {url}): {e}")
+                if is_outage(e): return False  # tenta na próxima rodada
+            self.amends.pop(url)
+        return True
+
+    def dead_letter(self, rows: List[dict], reason: str):
+        print(f"Histórico: {len(rows)} linhas para o dead-letter ({reason})")
+        with open(HISTORY_DEAD_LETTER, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps({"reason": reason, "row": row}) + "\n" for row in rows)
+
+    def rewrite_spool(self):
+        tmp = self.spool.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(row) + "\n" for row in self.rows)
+        os.replace(tmp, self.spool)
+
+    async def insert(self, rows: List[dict]) -> Optional[Exception]:
+        try:
+            with stage("history", "insert", upstream="supabase"): await run_sync(insert_history, rows)
+            return None
+        except Exception as e:
+            return e
+
+    async def insert_rows(self, batch: List[dict]) -> int:
+        """Lote recusado: insere linha a linha, degradando para as colunas básicas antes do dead-letter.
+        Devolve quantas linhas foram resolvidas (para numa queda do Supabase)."""
+        for done, row in enumerate(batch):
+            error = await self.insert([row])
+            if error is None: continue
+            if is_outage(error): return done
+            base = {k: row[k] for k in HISTORY_BASE_COLUMNS if k in row}
+            if len(base) < len(row) and await self.insert([base]) is None:
+                print(f"Histórico: linha gravada sem as colunas extras ({error})")
+                continue
+            self.dead_letter([row], str(error))
+        return len(batch)
+
+    async def flush(self) -> bool:
+        while self.rows:
+            batch = self.rows[:HISTORY_BATCH_SIZE]
+            resolved = len(batch)
+            for attempt in range(HISTORY_RETRIES):
+                error = await self.insert(batch)
+                if error is None: break
+                print(f"Erro Histórico (tentativa {attempt + 1}): {error}")
+                # Queda do Supabase: mantém tudo no buffer/spool e tenta na próxima rodada
+                if is_outage(error):
+                    if attempt + 1 == HISTORY_RETRIES: return False
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+                resolved = await self.insert_rows(batch)
+                break
+            del self.rows[:resolved]
+            self.rewrite_spool()
+            if resolved < len(batch): return False
+        return await self.apply_amends()
+
+    async def run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=HISTORY_FLUSH_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    async def close(self):
+        self.closing = True
+        if self.task:
+            self.wakeup.set()
+            await self.task
+        if not self.rows:  # tudo gravado: não deixa spool vazio por pid
+            self.spool.unlink(missing_ok=True)
+            if self.lock: self.spool.with_suffix(".lock").unlink(missing_ok=True)
+        if self.lock: self.lock.close()
+
+history_writer = HistoryWriter(HISTORY_SPOOL)
+
+def save_to_history(user_id: str, type: str, url: str, prompt: str, **extra):
+    history_writer.add({"user_id": user_id, "type": type, "url": url, "prompt": prompt,
+                        "created_at": datetime.now(timezone.utc).isoformat(), **extra})
+
+async def persist_output(reservation: str, uploads: List[tuple], user_id: str, type: str, prompt: str, **extra):
+    """Etapa pós-resposta: sobe os arquivos nas chaves já devolvidas (em paralelo), confirma a cobrança e registra."""
+    route = f"generate_{type}"
     try:
-        vid = VideoFileClip(path)
-        if lp.exists():
-            logo = (ImageClip(str(lp)).set_duration(vid.duration)
-                    .resize(height=vid.h * 0.15).margin(right=8, bottom=8, opacity=0)
-                    .set_pos(("right", "bottom")))
-            final = CompositeVideoClip([vid, logo])
-            final.write_videofile(out, codec="libx264", audio_codec="aac", preset="ultrafast", threads=1, logger=None)
-            vid.close(); final.close()
-            with open(out, "rb") as f: return f.read()
-        return v_bytes
+        with stage(route, "upload", upstream="supabase"):
+            await asyncio.gather(*(run_sync(upload_object, key, data, content_type) for key, data, content_type in uploads))
     except Exception as e:
-        print(f"Erro Video Watermark: {e}")
-        return v_bytes
-    finally:
-        try: 
-            if os.path.exists(path): os.remove(path)
-            if os.path.exists(out): os.remove(out)
-        except: pass
+        print(f"Erro Persistência {uploads[0][0]}: {e}")
+        await run_sync(refund_credits, reservation)
+        return
+    with stage(route, "commit_credits", upstream="supabase"): await run_sync(commit_credits, reservation)
+    save_to_history(user_id, type, public_object_url(uploads[0][0]), prompt, **extra)
 
-def decode_base64_image(image_string):
+def decode_base64_image(image_string) -> Optional[bytes]:
     """Decodifica imagem base64 de forma segura."""
     if not image_string: return None
     try:
         if "base64," in image_string:
             image_string = image_string.split("base64,")[1]
         image_data = base64.b64decode(image_string)
-        return Image.open(io.BytesIO(image_data))
+        Image.open(io.BytesIO(image_data))
+        return image_data
     except Exception as e:
         print(f"Erro Decode: {str(e)}")
         raise HTTPException(status_code=400, detail="Erro ao processar imagem: from_image (Formato inválido)")
@@ -128,21 +1255,55 @@ def decode_base64_image(image_string):
 @app.get("/")
 def read_root(): return {"status": "NastIA V9 (Final Launch) Online 🚀"}
 
+@app.get("/media-stats")
+def media_stats(): return media_workers.snapshot()
+
+@app.get("/metrics")
+def metrics_endpoint(): return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- ROTA IMAGEM (COM SUPORTE TOTAL A FORMATOS) ---
+
+# Hedge opcional: se a chamada passar do p95 recente, dispara uma segunda igual e fica com a
+# primeira que voltar. Custa uma geração extra no Gemini (não no crédito do usuário). A segunda
+# chamada ocupa outra vaga do modelo e só sai se houver uma livre naquele momento.
+HEDGE_IMAGE = os.getenv("HEDGE_IMAGE", "0") == "1"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+image_latency = resilience.LatencyWindow()
+
+async def image_call(**kwargs):
+    t0 = time.perf_counter()
+    response = await client.aio.models.generate_content(**kwargs)
+    image_latency.record(time.perf_counter() - t0)
+    return response
+
+def image_hedge_delay() -> Optional[float]:
+    return image_latency.quantile(HEDGE_QUANTILE) if HEDGE_IMAGE else None
+
 @app.post("/generate-image")
 async def generate_image(
     prompt: str = Form(...), 
     files: List[UploadFile] = File(None), 
     from_image: str = Form(None),
+    source_generation_id: str = Form(None),
+    source_key: str = Form(None),
     user_id: str = Form(...),
-    aspect_ratio: str = Form("16:9")
+    aspect_ratio: str = Form("16:9"),
+    x_user_id: Optional[str] = Header(None)
 ):
+    check_user_header(x_user_id, user_id)
+    reservation = None
+    if files and len(files) > MAX_INPUT_IMAGES:
+        raise HTTPException(400, f"Envie no máximo {MAX_INPUT_IMAGES} imagens.")
+    if files and any((file.size or 0) > INPUT_IMAGE_MAX for file in files):
+        raise HTTPException(413, f"Cada imagem pode ter no máximo {INPUT_IMAGE_MAX // (1024 * 1024)} MB.")
     try:
-        has_input_image = (files and len(files) > 0) or (from_image is not None)
+        has_source = bool(source_generation_id or source_key)
+        has_input_image = (files and len(files) > 0) or (from_image is not None) or has_source
         cost = 10 if has_input_image else 5
-        user_plan = check_and_deduct_credits(user_id, cost)
+        with stage("generate_image", "reserve_credits"):
+            reservation, user_plan = await run_sync(reserve_credits, user_id, cost)
         
-        model = "gemini-2.5-flash-image"
+        model = IMAGE_MODEL
         
         ratio_map = {
             "16:9": "wide 16:9 aspect ratio",
@@ -160,48 +1321,382 @@ async def generate_image(
             final_prompt = prompt
 
         contents_parts = [types.Part.from_text(text=final_prompt)]
-        input_img = None
+        inputs: List[bytes] = []
         
-        if files:
-            for file in files:
-                f_bytes = await file.read()
-                input_img = Image.open(io.BytesIO(f_bytes))
-        elif from_image:
-            input_img = decode_base64_image(from_image)
-
-        if input_img:
-            if input_img.mode != 'RGB':
-                input_img = input_img.convert('RGB')
-            buf = io.BytesIO()
-            input_img.save(buf, format="JPEG")
-            img_bytes = buf.getvalue()
+        with stage("generate_image", "read_inputs", upstream="supabase" if has_source else None):
+            if files:
+                inputs = await asyncio.gather(*(file.read() for file in files))
+                BYTES.inc(sum(map(len, inputs)), direction="in", peer="client")
+            elif has_source:
+                inputs = [await run_sync(load_source_asset, user_id, source_generation_id, source_key)]
+            elif from_image:
+                inputs = [await run_sync(decode_base64_image, from_image)]
+                BYTES.inc(len(from_image), direction="in", peer="client")
+
+        # Cada imagem vira uma Part; a normalização roda em paralelo no pool de mídia
+        with stage("generate_image", "normalize"):
+            normalized = await asyncio.gather(*(media_workers.submit(normalize_input_image, data) for data in inputs))
+        for img_bytes in normalized:
             contents_parts.append(types.Part.from_bytes(data=img_bytes, mime_type="image/jpeg"))
         
         contents = [types.Content(role="user", parts=contents_parts)]
         generation_config = types.GenerateContentConfig(response_modalities=["IMAGE"])
         
-        response = client.models.generate_content(
-            model=model, 
-            contents=contents, 
-            config=generation_config
-        )
+        async with model_slot(model, user_plan, user_id):
+            with stage("generate_image", "model", upstream="gemini"):
+                call = lambda: image_call(model=model, contents=contents, config=generation_config)
+                response = await resilience.call_async(model_breaker(model), lambda: resilience.hedged(
+                    "generate_image", call, image_hedge_delay(), hedge=lambda: spare_slot_call(model, call)
+                ))
 
         if response.candidates and response.candidates[0].content.parts:
             for part in response.candidates[0].content.parts:
                 if part.inline_data:
-                    gen_img = Image.open(io.BytesIO(part.inline_data.data))
-                    final_img = apply_watermark(gen_img, user_plan)
-                    buf = io.BytesIO()
-                    final_img.save(buf, format="JPEG", quality=95)
-                    public_url = upload_to_supabase(buf.getvalue(), "jpg", "image/jpeg")
-                    save_to_history(user_id, "image", public_url, prompt)
-                    return {"image": public_url}
+                    BYTES.inc(len(part.inline_data.data), direction="in", peer="gemini")
+                    with stage("generate_image", "render"):
+                        renditions = await media_workers.submit(render_output_set, part.inline_data.data, user_plan)
+                    # As chaves são definidas aqui; upload, cobrança e histórico seguem em background
+                    uploads = [(object_key(data, ext), data, content_type)
+                               for data, ext, content_type in (renditions[name] for name in ("master", "web", "thumb"))]
+                    hot_assets.put(uploads[0][0], uploads[0][1])
+                    urls = [public_object_url(key) for key, _, _ in uploads]
+                    extra = {"web_url": urls[1], "thumb_url": urls[2], "lqip": renditions["lqip"]}
+                    spawn_job(persist_output(reservation, uploads, user_id, "image", prompt, **extra))
+                    return {"image": urls[0], **extra}
                     
         raise HTTPException(500, "O Google não retornou imagem.")
     except Exception as e:
+        await run_sync(refund_credits, reservation)
         print(f"Erro Geral Imagem: {e}")
+        if isinstance(e, HTTPException): raise
+        failure = upstream_failure(e, IMAGE_MODEL)
+        if failure: raise failure
         traceback.print_exc() 
-        raise HTTPException(500, str(e))
+        raise HTTPException(400 if isinstance(e, InputImageError) else 500, str(e))
+
+# --- FILA DE VÍDEO (JOBS ASSÍNCRONOS) ---
+# O Veo leva minutos para renderizar: a rota só cobra, submete a operação e devolve o job_id.
+# O acompanhamento roda em background e o front consulta GET /jobs/{id}. A vaga do Veo
+# (MODEL_CONCURRENCY) fica presa do submit até o render terminar, então a fila por plano
+# decide quem renderiza quando a cota aperta; 429 de cota devolve o job à fila.
+# Com vários workers o GET pode cair em outro processo: cada mudança de estado também vai
+# para a tabela video_jobs (JOB_BACKEND=supabase, padrão), inclusive o nome da operação do
+# Veo, para que um render sobreviva a restart/deploy. JOB_BACKEND=memory só serve para um
+# único worker.
+VIDEO_POLL_MIN = float(os.getenv("VIDEO_POLL_MIN", "2"))
+VIDEO_POLL_MAX = float(os.getenv("VIDEO_POLL_MAX", "20"))
+VIDEO_POLL_CONCURRENCY = int(os.getenv("VIDEO_POLL_CONCURRENCY", "8"))
+VIDEO_EXPECTED_RENDER = float(os.getenv("VIDEO_EXPECTED_RENDER", "60"))
+VIDEO_JOB_TIMEOUT = float(os.getenv("VIDEO_JOB_TIMEOUT", "900"))
+VIDEO_QUEUE_TIMEOUT = float(os.getenv("VIDEO_QUEUE_TIMEOUT", "600"))  # espera máxima na fila antes de estornar
+VIDEO_QUOTA_BACKOFF = float(os.getenv("VIDEO_QUOTA_BACKOFF", "30"))  # cota do Veo esgotada: espera antes de voltar à fila
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+JOB_DRAIN_TIMEOUT = float(os.getenv("JOB_DRAIN_TIMEOUT", "30"))  # no shutdown: espera uploads/commits em background
+JOB_BACKEND = os.getenv("JOB_BACKEND", "supabase")
+# Job não terminado (na fila, submetendo ou renderizando) renova a linha a cada JOB_HEARTBEAT s.
+# Linha parada há 3 heartbeats é de um worker que morreu (deploy, queda): outro worker adota o
+# render pelo nome da operação do Veo; sem operação (fila/submissão) não há o que retomar e o
+# job vira erro com estorno.
+JOB_HEARTBEAT = float(os.getenv("JOB_HEARTBEAT", "60"))
+JOB_STALE = JOB_HEARTBEAT * 5  # sem atualização há tanto tempo nem a recuperação resolveu: o GET já responde erro
+jobs: Dict[str, dict] = {}
+_job_tasks: set = set()
+_job_writers: Dict[str, asyncio.Task] = {}
+
+class SupabaseJobBackend:
+    """Estado dos jobs na tabela video_jobs (backend/sql/video_jobs.sql)."""
+    def load(self, job_id: str) -> Optional[dict]:
+        res = supabase_call(supabase.table("video_jobs").select("data").eq("id", job_id).execute)
+        return res.data[0]["data"] if res.data else None
+
+    def save(self, job: dict):
+        supabase_call(supabase.table("video_jobs").upsert({"id": job["id"], "data": job,
+                                                           "updated_at": datetime.now(timezone.utc).isoformat()}).execute)
+
+    def orphans(self, idle: float) -> List[dict]:
+        cutoff = datetime.fromtimestamp(time.time() - idle, timezone.utc).isoformat()
+        res = supabase_call(supabase.table("video_jobs").select("data, updated_at")
+                            .in_("data->>status", ["queued", "submitting", "running"]).lt("updated_at", cutoff).execute)
+        return res.data or []
+
+    def claim(self, row: dict) -> bool:
+        """Só um worker adota: o update só pega se ninguém tocou a linha desde a leitura."""
+        res = supabase_call(supabase.table("video_jobs").update({"updated_at": datetime.now(timezone.utc).isoformat()})
+                            .eq("id", row["data"]["id"]).eq("updated_at", row["updated_at"]).execute, idempotent=False)
+        return bool(res.data)
+
+job_backend = SupabaseJobBackend() if JOB_BACKEND == "supabase" else None
+
+async def job_writer(job: dict):
+    # Uma escrita por vez por job, sempre com o estado mais recente: "running" atrasado não sobrescreve "done"
+    while job.pop("dirty", False):
+        try: await run_sync(job_backend.save, dict(job))
+        except Exception as e: print(f"Erro Job {job['id']}: {e}")
+    _job_writers.pop(job["id"], None)
+
+def persist_job(job: dict):
+    if job_backend is None: return
+    job["dirty"] = True
+    if job["id"] not in _job_writers: _job_writers[job["id"]] = spawn_job(job_writer(job))
+
+async def find_job(job_id: str) -> Optional[dict]:
+    job = jobs.get(job_id)
+    if job or job_backend is None: return job
+    try:
+        job = await run_sync(job_backend.load, job_id)
+    except Exception as e:
+        print(f"Erro Job {job_id}: {e}")
+        return None
+    if job and job["status"] not in ("done", "error") and time.time() - job["updated_at"] > JOB_STALE:
+        job = {**job, "status": "error", "error": "O processamento foi interrompido. Os créditos serão devolvidos."}
+    return job
+
+def create_job(user_id: str, type: str, prompt: str, **extra) -> dict:
+    job = {"id": os.urandom(8).hex(), "user_id": user_id, "type": type, "prompt": prompt,
+           "status": "pending", "url": None, "error": None, "created_at": time.time(), "updated_at": time.time()}
+    job.update(extra)
+    jobs[job["id"]] = job
+    persist_job(job)
+    return job
+
+def update_job(job: dict, **fields):
+    job.update(fields)
+    job["updated_at"] = time.time()
+    persist_job(job)
+
+def purge_jobs():
+    limit = time.time() - JOB_TTL
+    for jid in [j["id"] for j in jobs.values() if j["status"] in ("done", "error") and j["updated_at"] < limit]:
+        jobs.pop(jid, None)
+
+async def finish_video_job(job: dict, operation):
+    paths = []
+    try:
+        if operation.error: raise Exception(f"Veo: {operation.error}")
+        res = operation.result
+        if not (res and res.generated_videos): raise Exception("O Google não retornou vídeo.")
+        with stage("generate_video", "download", upstream="veo"):
+            final_path = await run_sync(resilience.call_sync, model_breaker(VIDEO_MODEL), partial(download_video, res.generated_videos[0].video))
+        paths.append(final_path)
+        if not (job["is_image_animation"] or job["plan"] in ["plus", "pro"]):
+            paths.append(final_path.replace(".mp4", "_wm.mp4"))
+            with stage("generate_video", "watermark"):
+                final_path = await media_workers.submit(apply_video_watermark, paths[0], paths[1], job["plan"])
+        with stage("generate_video", "upload"):
+            url = await run_sync(upload_file, final_path, "mp4", "video/mp4")
+        if not url:
+            UPSTREAM_ERRORS.inc(upstream="supabase", stage="upload")
+            raise Exception("Erro ao salvar o vídeo.")
+        with stage("generate_video", "commit_credits", upstream="supabase"):
+            await run_sync(commit_credits, job["reservation"])
+        update_job(job, status="done", url=url)
+        save_to_history(job["user_id"], "video", url, job["prompt"])  # já, sem esperar pelos derivados
+        spawn_job(video_derivatives(job, final_path, url, paths))
+        paths = []  # os derivados cuidam da limpeza
+    except Exception as e:
+        print(f"Erro Job Vídeo {job['id']}: {e}")
+        await fail_job(job, str(e))
+    finally:
+        remove_files(paths)
+
+VIDEO_RENDITIONS = [int(h) for h in os.getenv("VIDEO_RENDITIONS", "").split(",") if h.strip()]
+
+async def video_derivatives(job: dict, path: str, url: str, cleanup: List[str]):
+    """Depois do vídeo entregue: poster, prévia leve e resoluções extras, completando o histórico."""
+    ladder_paths = [path.replace(".mp4", f"_{h}p.mp4") for h in VIDEO_RENDITIONS]
+    t0 = time.perf_counter()
+    try:
+        tasks = [media_workers.submit(video_poster, path), media_workers.submit(video_preview, path)]
+        tasks += [media_workers.submit(video_rendition, path, h, LADDER_BITRATES.get(h, "1M"), None, dst)
+                  for h, dst in zip(VIDEO_RENDITIONS, ladder_paths)]
+        poster, preview, *_ = await asyncio.gather(*tasks)
+        urls = await asyncio.gather(run_sync(upload_to_supabase, poster, "jpg", "image/jpeg"),
+                                    run_sync(upload_to_supabase, preview, "mp4", "video/mp4"),
+                                    *(run_sync(upload_file, dst, "mp4", "video/mp4") for dst in ladder_paths))
+        extra = {"poster_url": urls[0] or None, "preview_url": urls[1] or None}
+        if VIDEO_RENDITIONS: extra["renditions"] = {str(h): u for h, u in zip(VIDEO_RENDITIONS, urls[2:]) if u}
+        update_job(job, **extra)
+        history_writer.amend(url, extra)
+    except Exception as e:
+        print(f"Erro Derivados Vídeo {job['id']}: {e}")
+    finally:
+        remove_files(cleanup + ladder_paths)
+        STAGE_SECONDS.observe(time.perf_counter() - t0, route="generate_video", stage="derivatives")
+
+async def fail_job(job: dict, error: str):
+    update_job(job, status="error", error=error)
+    await run_sync(refund_credits, job.get("reservation"))
+
+def spawn_job(coro):
+    task = asyncio.create_task(coro)
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+    return task
+
+async def drain_jobs(timeout: float):
+    """Espera as tarefas em background (que podem criar outras) até `timeout` s."""
+    deadline = time.monotonic() + timeout
+    while _job_tasks and time.monotonic() < deadline:
+        await asyncio.wait(set(_job_tasks), timeout=deadline - time.monotonic())
+    if _job_tasks: print(f"Encerrando com {len(_job_tasks)} tarefas em background ainda em andamento")
+
+# --- POLLER ÚNICO DAS OPERAÇÕES VEO ---
+# Uma só corrotina acompanha todas as operações pendentes. O intervalo de cada uma
+# depende da idade e do tempo de render observado: devagar enquanto o vídeo é novo,
+# rápido perto do término esperado. As consultas saem em lote sob um único limite.
+class VeoPoller:
+    def __init__(self):
+        self.pending: Dict[str, dict] = {}
+        self.render_times: List[float] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.sem: Optional[asyncio.Semaphore] = None
+
+    def expected_render(self) -> float:
+        if not self.render_times: return VIDEO_EXPECTED_RENDER
+        ordered = sorted(self.render_times)
+        return ordered[len(ordered) // 2]
+
+    def next_interval(self, age: float) -> float:
+        remaining = self.expected_render() - age
+        if remaining > 0:
+            # Ainda longe do fim: espera metade do que falta (dentro dos limites)
+            return min(VIDEO_POLL_MAX, max(VIDEO_POLL_MIN, remaining / 2))
+        # Passou do esperado: volta a espaçar aos poucos
+        return min(VIDEO_POLL_MAX, VIDEO_POLL_MIN + (-remaining) / 10)
+
+    def add(self, job: dict, operation, done: Optional[Callable[[], None]] = None):
+        """`done` roda quando a operação termina (ou estoura o tempo): devolve a vaga do Veo."""
+        now = time.time()
+        started = job.get("render_started") or now  # job adotado de outro worker mantém o início do render
+        self.pending[job["id"]] = {"job": job, "operation": operation, "started": started, "done": done,
+                                   "next_poll": now + self.next_interval(now - started)}
+        update_job(job, status="running", operation=operation.name, render_started=started)
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.sem = asyncio.Semaphore(VIDEO_POLL_CONCURRENCY)
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+
+    def finish(self, entry: dict):
+        self.pending.pop(entry["job"]["id"], None)
+        if entry["done"]: entry["done"]()
+
+    async def check(self, entry: dict):
+        async with self.sem:
+            try:
+                VEO_POLLS.inc()
+                # Sem retry aqui: a própria próxima rodada do poller é a nova tentativa
+                entry["operation"] = await resilience.call_async(model_breaker(VIDEO_MODEL), lambda: client.aio.operations.get(entry["operation"]), attempts=1)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(upstream="veo", stage="poll")
+                print(f"Erro Poll Veo {entry['job']['id']}: {e}")
+        now = time.time()
+        if entry["operation"].done:
+            self.finish(entry)
+            self.render_times = (self.render_times + [now - entry["started"]])[-50:]
+            STAGE_SECONDS.observe(now - entry["started"], route="generate_video", stage="render")
+            spawn_job(finish_video_job(entry["job"], entry["operation"]))
+        elif now - entry["started"] > VIDEO_JOB_TIMEOUT:
+            self.finish(entry)
+            await fail_job(entry["job"], "Tempo limite do render excedido.")
+        else:
+            entry["next_poll"] = now + self.next_interval(now - entry["started"])
+            if now - entry["job"]["updated_at"] > JOB_HEARTBEAT: update_job(entry["job"])
+
+    async def run(self):
+        while True:
+            now = time.time()
+            due = [e for e in self.pending.values() if e["next_poll"] <= now]
+            if due:
+                await asyncio.gather(*(self.check(e) for e in due))
+                continue
+            self.wakeup.clear()
+            timeout = min((e["next_poll"] for e in self.pending.values()), default=now + VIDEO_POLL_MAX) - now
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+veo_poller = VeoPoller()
+
+def heartbeat_jobs():
+    # Cobre quem o poller não renova: fila, submissão e o download/upload depois do render
+    now = time.time()
+    for job in list(jobs.values()):
+        if job["status"] in ("queued", "submitting", "running") and now - job["updated_at"] > JOB_HEARTBEAT / 2:
+            update_job(job)
+
+async def recover_video_jobs():
+    """Retoma o polling dos renders cujo worker morreu; a cobrança e o histórico seguem normalmente.
+    Jobs órfãos ainda sem operação do Veo viram erro e a reserva é estornada."""
+    try:
+        rows = await run_sync(job_backend.orphans, JOB_HEARTBEAT * 3)
+    except Exception as e:
+        print(f"Erro Recuperação Jobs: {e}")
+        return
+    for row in rows:
+        job = row["data"]
+        if job["id"] in jobs: continue
+        try:
+            if not await run_sync(job_backend.claim, row): continue
+        except Exception as e:
+            print(f"Erro Recuperação Job {job['id']}: {e}")
+            continue
+        if not job.get("operation"):
+            print(f"Job {job['id']}: interrompido em {job['status']}, sem operação do Veo")
+            await fail_job(job, "O processamento foi interrompido. Os créditos foram devolvidos.")
+            continue
+        jobs[job["id"]] = job
+        if job.get("reservation"):
+            with _ledger_lock: _open_reservations.add(job["reservation"])
+        veo_poller.add(job, types.GenerateVideosOperation(name=job["operation"]))
+        print(f"Job {job['id']}: render do Veo retomado")
+
+async def watch_video_jobs():
+    while True:
+        heartbeat_jobs()
+        await recover_video_jobs()
+        await asyncio.sleep(JOB_HEARTBEAT)
+
+async def submit_video_job(job: dict, veo_params: dict):
+    """Espera a vez na fila de prioridade do Veo e submete a operação; o poller segue daí.
+    A vaga fica com o job até o render terminar: é ela que limita os renders em andamento.
+    Cota esgotada (429) não estorna: o job volta para a fila depois de VIDEO_QUOTA_BACKOFF s."""
+    gate = model_gate(VIDEO_MODEL)
+    deadline = time.monotonic() + VIDEO_QUEUE_TIMEOUT
+    started, handed_over = None, False
+    try:
+        while True:
+            started = await take_slot(VIDEO_MODEL, job["plan"], job["user_id"], ticket=job,
+                                      timeout=max(deadline - time.monotonic(), 0))
+            try:
+                update_job(job, status="submitting")
+                with stage("generate_video", "submit", upstream="veo"):
+                    operation = await resilience.call_async(model_breaker(VIDEO_MODEL), lambda: client.aio.models.generate_videos(**veo_params), idempotent=False)
+                break
+            except Exception as e:
+                if not is_quota_error(e) or deadline - time.monotonic() < VIDEO_QUOTA_BACKOFF: raise
+                print(f"Vídeo {job['id']}: cota do Veo esgotada, voltando para a fila")
+                give_slot(VIDEO_MODEL, started)
+                started = None
+                update_job(job, status="queued")
+                await asyncio.sleep(VIDEO_QUOTA_BACKOFF)
+        def render_done():
+            give_slot(VIDEO_MODEL, started)
+            gate.leave()
+        veo_poller.add(job, operation, render_done)
+        handed_over = True
+    except asyncio.TimeoutError:
+        await fail_job(job, "A fila de vídeos está longa demais no momento. Os créditos foram devolvidos.")
+    except Exception as e:
+        print(f"Erro Vídeo {job['id']}: {e}")
+        failure = upstream_failure(e, VIDEO_MODEL)
+        await fail_job(job, failure.detail if failure else str(e))
+    finally:
+        if not handed_over:
+            if started is not None: give_slot(VIDEO_MODEL, started)
+            gate.leave()
 
 # --- ROTA VÍDEO ---
 @app.post("/generate-video")
@@ -209,12 +1704,16 @@ async def generate_video(
     prompt: str = Form(...), 
     file_start: UploadFile = File(None), 
     user_id: str = Form(...),
-    aspect_ratio: str = Form("16:9")
+    aspect_ratio: str = Form("16:9"),
+    x_user_id: Optional[str] = Header(None)
 ):
+    check_user_header(x_user_id, user_id)
+    reservation = None
     try:
         cost = 20
-        user_plan = check_and_deduct_credits(user_id, cost)
-        model = "veo-3.1-generate-preview"
+        with stage("generate_video", "reserve_credits"):
+            reservation, user_plan = await run_sync(reserve_credits, user_id, cost)
+        model = VIDEO_MODEL
         
         veo_params = {
             "model": model, 
@@ -228,46 +1727,51 @@ async def generate_video(
         is_image_animation = False
         if file_start:
             s_bytes = await file_start.read()
+            BYTES.inc(len(s_bytes), direction="in", peer="client")
             mime = file_start.content_type or "image/jpeg"
             veo_params["image"] = types.Image(image_bytes=s_bytes, mime_type=mime)
             is_image_animation = True
 
-        operation = client.models.generate_videos(**veo_params)
-        while not operation.done:
-            time.sleep(5)
-            operation = client.operations.get(operation)
-
-        res = operation.result
-        if res and res.generated_videos:
-            v_bytes = client.files.download(file=res.generated_videos[0].video)
-            if is_image_animation or user_plan in ["plus", "pro"]:
-                final_bytes = v_bytes
-            else:
-                final_bytes = apply_video_watermark(v_bytes, user_plan)
-            public_url = upload_to_supabase(final_bytes, "mp4", "video/mp4")
-            save_to_history(user_id, "video", public_url, prompt)
-            return {"video": public_url}
-        raise HTTPException(500, "O Google não retornou vídeo.")
+        # A espera pela vez (por plano) e a submissão ao Veo seguem no job; a cobrança já está reservada
+        purge_jobs()
+        job = create_job(user_id, "video", prompt, plan=user_plan, is_image_animation=is_image_animation,
+                         reservation=reservation, status="queued")
+        model_gate(model).hold()
+        spawn_job(submit_video_job(job, veo_params))
+        return {"job_id": job["id"], "status": job["status"]}
     except Exception as e:
+        await run_sync(refund_credits, reservation)
         print(f"Erro Vídeo: {e}")
+        failure = upstream_failure(e, VIDEO_MODEL)
+        if failure: raise failure
         raise HTTPException(status_code=402 if "Saldo" in str(e) else 500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await find_job(job_id)
+    if not job: raise HTTPException(404, "Job não encontrado.")
+    # A posição na fila só é conhecida pelo worker dono do job
+    position = model_gate(VIDEO_MODEL).position(job) if job["status"] == "queued" and job_id in jobs else None
+    return {"id": job["id"], "type": job["type"], "status": job["status"], "url": job["url"], "error": job["error"],
+            job["type"]: job["url"], "poster_url": job.get("poster_url"), "preview_url": job.get("preview_url"),
+            "queue_position": position}
+
 # --- NOVA ROTA: RESGATAR MOEDAS POR PLANO PLUS ---
 @app.post("/redeem-coins")
 async def redeem_coins_endpoint(user_id: str = Form(...)):
     try:
-        user_res = supabase.table("profiles").select("coins, plan_tier").eq("id", user_id).execute()
+        user_res = await run_sync(supabase_call, supabase.table("profiles").select("coins, plan_tier").eq("id", user_id).execute)
         if not user_res.data: raise HTTPException(404, "User not found")
         
         user = user_res.data[0]
         if (user.get('coins') or 0) < 250:
             raise HTTPException(400, "Saldo de moedas insuficiente.")
             
-        supabase.table("profiles").update({
+        await run_sync(supabase_call, supabase.table("profiles").update({
             "coins": user['coins'] - 250,
             "plan_tier": "plus",
             "credits": 1000 # Bônus de boas-vindas ao Plus
-        }).eq("id", user_id).execute()
+        }).eq("id", user_id).execute)
         
         return {"status": "success", "message": "Plano Plus ativado!"}
     except Exception as e:
@@ -280,31 +1784,32 @@ class ReferralRequest(BaseModel):
     referral_code: str
 
 @app.post("/track-referral")
-async def track_referral_endpoint(req: ReferralRequest):
+async def track_referral_endpoint(req: ReferralRequest, x_user_id: Optional[str] = Header(None)):
+    check_user_header(x_user_id, req.user_id)
     try:
-        user_check = supabase.table("profiles").select("referred_by, signup_bonus_given, credits").eq("id", req.user_id).execute()
+        user_check = await run_sync(supabase_call, supabase.table("profiles").select("referred_by, signup_bonus_given, credits").eq("id", req.user_id).execute)
         if not user_check.data: return {"status": "error", "message": "User not found"}
         
         user_data = user_check.data[0]
         if user_data.get('referred_by') or user_data.get('signup_bonus_given'):
              return {"status": "ignored", "message": "Already referred"}
 
-        referrer = supabase.table("profiles").select("id, credits").eq("referral_code", req.referral_code).execute()
+        referrer = await run_sync(supabase_call, supabase.table("profiles").select("id, credits").eq("referral_code", req.referral_code).execute)
         
         if referrer.data:
             ref_id = referrer.data[0]['id']
             ref_credits = referrer.data[0]['credits']
             
             # Padrinho ganha 100 créditos
-            supabase.table("profiles").update({"credits": ref_credits + 100}).eq("id", ref_id).execute()
+            await run_sync(supabase_call, supabase.table("profiles").update({"credits": ref_credits + 100}).eq("id", ref_id).execute)
             
             # Afilhado ganha 50 créditos extras
             current_credits = user_data['credits']
-            supabase.table("profiles").update({
+            await run_sync(supabase_call, supabase.table("profiles").update({
                 "referred_by": req.referral_code,
                 "signup_bonus_given": True,
                 "credits": current_credits + 50
-            }).eq("id", req.user_id).execute()
+            }).eq("id", req.user_id).execute)
             
             return {"status": "success"}
             
@@ -314,24 +1819,239 @@ async def track_referral_endpoint(req: ReferralRequest):
         print(f"Referral Error: {e}")
         return {"status": "error"}
 
+# --- SESSÕES DE CHAT ---
+# O cliente manda só session_id + mensagem nova; o histórico fica no servidor (LRU com TTL
+# em memória e, opcionalmente, persistido no Supabase). Antes de cada chamada a conversa
+# é cortada num orçamento de tokens e os turnos antigos viram um resumo.
+# Sessão que não existe aqui (expirou, saiu do LRU ou está em outro worker sem o backend
+# Supabase) responde 409: o cliente reenvia a conversa local em history e a sessão recomeça dela.
+CHAT_MODEL = "gemini-3-pro-preview"
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "gemini-2.5-flash")
+CHAT_SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "86400"))
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "5000"))
+CHAT_SESSION_BACKEND = os.getenv("CHAT_SESSION_BACKEND", "memory")
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "32000"))
+CHAT_SUMMARY_TRIGGER = int(os.getenv("CHAT_SUMMARY_TRIGGER", "24000"))
+CHAT_KEEP_TURNS = int(os.getenv("CHAT_KEEP_TURNS", "6"))
+# Longe do gatilho do resumo, os turnos do usuário são estimados localmente (~4 caracteres por
+# token). Só quando a estimativa passa de CHAT_COUNT_RATIO do gatilho o count_tokens é chamado,
+# uma vez por turno, para decidir o resumo e a janela com a contagem exata.
+CHAT_COUNT_RATIO = float(os.getenv("CHAT_COUNT_RATIO", "0.8"))
+
+class SupabaseChatBackend:
+    """Persistência das sessões na tabela chat_sessions (backend/sql/chat_sessions.sql)."""
+    def load(self, session_id: str) -> Optional[dict]:
+        res = supabase_call(supabase.table("chat_sessions").select("data").eq("id", session_id).execute)
+        return res.data[0]["data"] if res.data else None
+
+    def save(self, session: dict):
+        supabase_call(supabase.table("chat_sessions").upsert({"id": session["id"], "data": session,
+                                                              "updated_at": datetime.now(timezone.utc).isoformat()}).execute)
+
+class ChatSessions:
+    def __init__(self, backend=None):
+        self.items: "OrderedDict[str, dict]" = OrderedDict()
+        self.backend = backend
+
+    async def get(self, session_id: Optional[str]) -> Optional[dict]:
+        """Sessão pelo id (nova se não veio id); None se o id veio mas a sessão não está disponível."""
+        if not session_id:
+            return {"id": os.urandom(16).hex(), "summary": None, "summary_tokens": 0, "turns": [], "updated_at": time.time()}
+        session = self.items.get(session_id)
+        if session is None and self.backend:
+            try: session = await run_sync(self.backend.load, session_id)
+            except Exception as e: print(f"Erro Sessão Chat {session_id}: {e}")
+        if session is None or time.time() - session["updated_at"] > CHAT_SESSION_TTL: return None
+        # Cópia: se a chamada ao modelo falhar, a sessão guardada não fica com a mensagem pela metade
+        return {**session, "turns": list(session["turns"])}
+
+    async def save(self, session: dict):
+        session["updated_at"] = time.time()
+        self.items[session["id"]] = session
+        self.items.move_to_end(session["id"])
+        while len(self.items) > CHAT_SESSION_MAX: self.items.popitem(last=False)
+        if self.backend:
+            try: await run_sync(self.backend.save, session)
+            except Exception as e: print(f"Erro Sessão Chat {session['id']}: {e}")
+
+chat_sessions = ChatSessions(SupabaseChatBackend() if CHAT_SESSION_BACKEND == "supabase" else None)
+
+async def count_tokens(text: str) -> int:
+    res = await resilience.call_async(model_breaker(CHAT_MODEL), lambda: client.aio.models.count_tokens(model=CHAT_MODEL, contents=text))
+    return res.total_tokens or 0
+
+async def summarize_session(session: dict):
+    old, session["turns"] = session["turns"][:-CHAT_KEEP_TURNS], session["turns"][-CHAT_KEEP_TURNS:]
+    transcript = "\n".join(f"{t['role']}: {t['text']}" for t in old)
+    prompt = (f"Resumo anterior:\n{session['summary']}\n\n" if session["summary"] else "") + \
+        "Resuma a conversa abaixo em português, mantendo fatos, decisões, preferências do usuário e prompts já criados:\n\n" + transcript
+    async with model_slot(CHAT_SUMMARY_MODEL):
+        res = await resilience.call_async(model_breaker(CHAT_SUMMARY_MODEL), lambda: client.aio.models.generate_content(model=CHAT_SUMMARY_MODEL, contents=prompt))
+    session["summary"] = res.text or session["summary"]
+    session["summary_tokens"] = await count_tokens(session["summary"] or "")
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+async def session_contents(session: dict) -> List[types.Content]:
+    turns = session["turns"]
+    total = lambda: session["summary_tokens"] + sum(t.get("tokens", estimate_tokens(t["text"])) for t in session["turns"])
+    if total() > CHAT_SUMMARY_TRIGGER * CHAT_COUNT_RATIO:
+        missing = [t for t in turns if "tokens" not in t]
+        try:
+            for turn, tokens in zip(missing, await asyncio.gather(*(count_tokens(t["text"]) for t in missing))):
+                turn["tokens"] = tokens
+        except Exception as e:
+            print(f"Erro Contagem Tokens: {e}")  # segue com a estimativa
+    if total() > CHAT_SUMMARY_TRIGGER and len(turns) > CHAT_KEEP_TURNS:
+        try: await summarize_session(session)
+        except Exception as e: print(f"Erro Resumo Chat: {e}")
+    # Janela: se ainda não couber, descarta os turnos mais antigos (a conversa sempre começa no usuário)
+    while len(session["turns"]) > 1 and (total() > CHAT_CONTEXT_TOKENS or session["turns"][0]["role"] != "user"):
+        session["turns"].pop(0)
+    contents = []
+    if session["summary"]:
+        contents += [types.Content(role="user", parts=[types.Part.from_text(text="Resumo da conversa até aqui:\n" + session["summary"])]),
+                     types.Content(role="model", parts=[types.Part.from_text(text="Entendido.")])]
+    return contents + [types.Content(role=t["role"], parts=[types.Part.from_text(text=t["text"])]) for t in session["turns"]]
+
+def add_model_turn(session: dict, text: str, usage=None):
+    turn = {"role": "model", "text": text}
+    if usage and usage.candidates_token_count: turn["tokens"] = usage.candidates_token_count
+    session["turns"].append(turn)
+
+# --- PERSONAS (instrução de sistema) ---
+# A instrução vai inline em cada chamada. Cache explícito de contexto no Gemini não compensa:
+# o mínimo aceito é 4096 tokens nos modelos Pro (1024 nos Flash) e cada persona tem ~150,
+# então nunca seria criado. O prefixo repetido já entra no cache implícito do Gemini.
+CHAT_BASE_INSTRUCTION = "Se pedir imagem use 'PROMPT: '. "
+PERSONAS = {
+    "criativo": "Você é o diretor de arte da Agência NastIA. Ajude o usuário a transformar ideias em prompts visuais "
+                "detalhados para imagens e vídeos: descreva sujeito, cenário, composição, enquadramento, iluminação, "
+                "paleta de cores, estilo (foto, ilustração, 3D, cinema), lente e clima. Para vídeo, descreva também "
+                "movimento de câmera, ritmo e ação. Quando o usuário quiser gerar, entregue o prompt final em inglês "
+                "depois de 'PROMPT:'.",
+    "copy": "Você é o redator publicitário da Agência NastIA. Escreva legendas, roteiros, headlines e CTAs persuasivos "
+            "em português do Brasil, adaptando tom e tamanho à rede social e ao público. Ofereça variações curtas e "
+            "longas e explique rapidamente a estratégia de cada uma.",
+    "trafego": "Você é o gestor de tráfego pago da Agência NastIA. Ajude a planejar campanhas em Meta Ads, Google Ads e "
+               "TikTok Ads: objetivos, públicos, segmentação, orçamento, estrutura de campanhas, criativos e métricas "
+               "(CPM, CPC, CTR, CPA, ROAS). Seja prático e sugira testes A/B.",
+    "social": "Você é o social media da Agência NastIA. Monte calendários editoriais, sugira pautas, formatos (reels, "
+              "carrossel, stories), frequência de postagem e tendências do momento, sempre alinhados ao nicho e aos "
+              "objetivos do usuário.",
+    "seo": "Você é o especialista em SEO da Agência NastIA. Ajude com pesquisa de palavras-chave, intenção de busca, "
+           "títulos, meta descriptions, estrutura de conteúdo, links internos e SEO local, explicando as prioridades.",
+    "vendas": "Você é o estrategista de vendas da Agência NastIA. Ajude a desenhar funis, ofertas, scripts de abordagem "
+              "e follow-up, quebra de objeções e otimização de conversão, com exemplos prontos para usar.",
+}
+
+def persona_config(persona: str) -> types.GenerateContentConfig:
+    # Persona desconhecida: o texto enviado é a própria instrução
+    return types.GenerateContentConfig(system_instruction=CHAT_BASE_INSTRUCTION + PERSONAS.get(persona, persona))
+
 # --- ROTA CHAT ---
-class ChatRequest(BaseModel): history: List[Dict[str, str]]; persona: str 
+class ChatRequest(BaseModel):
+    persona: str
+    user_id: Optional[str] = None
+    history: Optional[List[Dict[str, str]]] = None
+    session_id: Optional[str] = None
+    message: Optional[str] = None
+
+async def chat_request_args(req: ChatRequest, session: Optional[dict]) -> dict:
+    if session is not None:
+        fmt = await session_contents(session)
+    else:
+        fmt = [types.Content(role=m["role"], parts=[types.Part.from_text(text=m["parts"])]) for m in req.history or []]
+    return {"model": CHAT_MODEL, "contents": fmt, "config": persona_config(req.persona)}
+
+async def check_chat_user(req: ChatRequest, x_user_id: Optional[str]):
+    """O X-User-Id que escolheu o balde do limite de taxa precisa ser de um usuário que existe."""
+    check_user_header(x_user_id, req.user_id)
+    if not req.user_id: return
+    try:
+        plan = await run_sync(load_plan, req.user_id)
+    except Exception as e:
+        print(f"Erro Perfil Chat {req.user_id}: {e}")
+        raise HTTPException(503, "Não foi possível verificar o usuário. Tente novamente.", headers={"Retry-After": "1"})
+    if plan is None: raise HTTPException(403, "Usuário não encontrado.")
+
+async def open_chat_session(req: ChatRequest) -> Optional[dict]:
+    """Modo sessão (message presente): carrega a sessão e anexa a mensagem nova."""
+    if req.message is None:
+        if not req.history: raise HTTPException(400, "Envie message ou history.")
+        return None
+    session = await chat_sessions.get(req.session_id)
+    if session is None:
+        if not req.history: raise HTTPException(409, "Sessão de chat não encontrada. Reenvie a conversa em history.")
+        session = await chat_sessions.get(None)
+    if not session["turns"] and req.history:
+        # Sessão nova a partir da conversa que o cliente ainda tem
+        session["turns"] = [{"role": m["role"], "text": m["parts"]} for m in req.history]
+    session["turns"].append({"role": "user", "text": req.message})
+    return session
+
 @app.post("/chat")
-async def chat_endpoint(req: ChatRequest):
+async def chat_endpoint(req: ChatRequest, x_user_id: Optional[str] = Header(None)):
+    with stage("chat", "user", upstream="supabase"): await check_chat_user(req, x_user_id)
+    with stage("chat", "session"): session = await open_chat_session(req)
     try:
-        model = "gemini-3-pro-preview"
-        sys_inst = "Se pedir imagem use 'PROMPT: '. " + req.persona
-        fmt = [types.Content(role=m["role"], parts=[types.Part.from_text(text=m["parts"])]) for m in req.history]
-        res = client.models.generate_content(model=model, contents=fmt, config=types.GenerateContentConfig(system_instruction=sys_inst))
-        return {"response": res.text or "..."}
-    except Exception as e: raise HTTPException(500, str(e))
+        with stage("chat", "context", upstream="gemini"): args = await chat_request_args(req, session)
+        async with model_slot(CHAT_MODEL):
+            with stage("chat", "model", upstream="gemini"):
+                res = await resilience.call_async(model_breaker(CHAT_MODEL), lambda: client.aio.models.generate_content(**args))
+        if session is None: return {"response": res.text or "..."}
+        add_model_turn(session, res.text or "...", res.usage_metadata)
+        with stage("chat", "save"): await chat_sessions.save(session)
+        return {"response": res.text or "...", "session_id": session["id"]}
+    except Exception as e:
+        failure = upstream_failure(e, CHAT_MODEL)
+        if failure: raise failure
+        raise HTTPException(500, str(e))
+
+def sse(data: dict, event: Optional[str] = None) -> str:
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest, x_user_id: Optional[str] = Header(None)):
+    """Mesma conversa do /chat, mas repassando os trechos por SSE conforme o modelo gera."""
+    with stage("chat_stream", "user", upstream="supabase"): await check_chat_user(req, x_user_id)
+    with stage("chat_stream", "session"): session = await open_chat_session(req)
+    async def events():
+        text, usage = "", None
+        try:
+            if session is not None: yield sse({"session_id": session["id"]}, "session")
+            with stage("chat_stream", "context", upstream="gemini"): args = await chat_request_args(req, session)
+            async with model_slot(CHAT_MODEL):
+                with stage("chat_stream", "model", upstream="gemini"):
+                    t0 = time.perf_counter()
+                    # Só a abertura do stream é repetida: depois do primeiro trecho o texto já saiu
+                    stream = await resilience.call_async(model_breaker(CHAT_MODEL), lambda: client.aio.models.generate_content_stream(**args))
+                    async for chunk in stream:
+                        usage = chunk.usage_metadata or usage
+                        if chunk.text:
+                            if not text: STAGE_SECONDS.observe(time.perf_counter() - t0, route="chat_stream", stage="first_token")
+                            text += chunk.text
+                            yield sse({"text": chunk.text})
+            if session is not None:
+                add_model_turn(session, text or "...", usage)
+                with stage("chat_stream", "save"): await chat_sessions.save(session)
+            prompt = text.split("PROMPT:", 1)[1].strip() if "PROMPT:" in text else None
+            yield sse({"response": text or "...", "has_prompt": prompt is not None, "prompt": prompt,
+                       "session_id": session["id"] if session else None}, "done")
+        except Exception as e:
+            print(f"Erro Chat Stream: {e}")
+            yield sse({"detail": str(e)}, "error")
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # --- ROTA CUPOM ---
 class CouponRequest(BaseModel): user_id: str; code: str
 @app.post("/redeem-coupon")
 async def redeem_coupon_endpoint(req: CouponRequest):
     try:
-        supabase.rpc("redeem_coupon", {"user_id": req.user_id, "input_code": req.code}).execute()
+        # Não idempotente: o cupom só pode ser aplicado uma vez
+        await run_sync(supabase_call, supabase.rpc("redeem_coupon", {"user_id": req.user_id, "input_code": req.code}).execute, False)
         return {"message": "Sucesso!"}
     except Exception as e: 
         if "200" in str(e): return {"message": "Sucesso!"}
@@ -343,8 +2063,11 @@ async def stripe_webhook(request: Request):
     payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
 
+    import stripe
+    stripe.api_key = STRIPE_API_KEY
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        with stage("stripe_webhook", "verify"):
+            event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
     except: raise HTTPException(400, "Webhook Error")
 
     if event['type'] == 'checkout.session.completed':
@@ -360,23 +2083,24 @@ async def stripe_webhook(request: Request):
                 if session.get('mode') == 'subscription': new_plan = 'pro'
             
             try:
-                curr = supabase.table("profiles").select("credits, referred_by").eq("id", user_id).execute()
-                u_data = curr.data[0]
-                data = {"credits": u_data['credits'] + to_add}
-                if new_plan: data["plan_tier"] = new_plan
-                supabase.table("profiles").update(data).eq("id", user_id).execute()
+                with stage("stripe_webhook", "credits", upstream="supabase"):
+                    curr = await run_sync(supabase_call, supabase.table("profiles").select("credits, referred_by").eq("id", user_id).execute)
+                    u_data = curr.data[0]
+                    data = {"credits": u_data['credits'] + to_add}
+                    if new_plan: data["plan_tier"] = new_plan
+                    await run_sync(supabase_call, supabase.table("profiles").update(data).eq("id", user_id).execute)
                 
-                # Gamificação: Padrinho ganha moedas se indicado assinar
-                ref_code = u_data.get('referred_by')
-                if ref_code and new_plan:
-                    referrer = supabase.table("profiles").select("id, credits, coins").eq("referral_code", ref_code).execute()
-                    if referrer.data:
-                        ref_data = referrer.data[0]
-                        new_coins = (ref_data.get('coins') or 0) + 10
-                        supabase.table("profiles").update({
-                            "credits": ref_data['credits'] + 100,
-                            "coins": new_coins
-                        }).eq("id", ref_data['id']).execute()
+                    # Gamificação: Padrinho ganha moedas se indicado assinar
+                    ref_code = u_data.get('referred_by')
+                    if ref_code and new_plan:
+                        referrer = await run_sync(supabase_call, supabase.table("profiles").select("id, credits, coins").eq("referral_code", ref_code).execute)
+                        if referrer.data:
+                            ref_data = referrer.data[0]
+                            new_coins = (ref_data.get('coins') or 0) + 10
+                            await run_sync(supabase_call, supabase.table("profiles").update({
+                                "credits": ref_data['credits'] + 100,
+                                "coins": new_coins
+                            }).eq("id", ref_data['id']).execute)
                         
             except Exception as e: print(f"Stripe Error: {e}")
 
@@ -0,0 +1,239 @@
+# Transformações de mídia pesadas em CPU (marca d'água, JPEG, ffmpeg).
+# Fica fora do main.py para que os processos do pool de mídia importem só isto,
+# sem criar clientes do Supabase/Gemini em cada worker.
+import os
+import time
+import io
+import base64
+import struct
+import tempfile
+import subprocess
+from pathlib import Path
+from functools import lru_cache
+from typing import List, Optional, Union
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+load_dotenv(dotenv_path=Path(__file__).parent / ".env")
+
+# Logo carregado uma vez; versões redimensionadas ficam em LRU por largura de saída
+LOGO_PATH = Path(__file__).parent / "logo.png"
+
+def load_logo() -> Optional[Image.Image]:
+    if not LOGO_PATH.exists(): return None
+    try:
+        with Image.open(LOGO_PATH) as f: return f.convert("RGBA")
+    except Exception as e:
+        print(f"Erro Logo: {e}")
+        return None
+
+LOGO = load_logo()
+
+@lru_cache(maxsize=int(os.getenv("LOGO_CACHE_SIZE", "32")))
+def watermark_logo(width: int):
+    """Logo em RGB + máscara alfa, já no tamanho para uma imagem de `width` px."""
+    lw = int(width * 0.12)
+    lh = int(lw / (LOGO.width / LOGO.height))
+    logo = LOGO.resize((lw, lh), Image.Resampling.LANCZOS)
+    return logo.convert("RGB"), logo.getchannel("A")
+
+def apply_watermark(img: Image.Image, plan: str) -> Image.Image:
+    # PLANOS PAGOS NÃO TEM MARCA D'ÁGUA
+    if plan in ["plus", "pro", "agency", "criação"]: return img.convert("RGB")
+    
+    base = img.convert("RGB")
+    if LOGO is None: return base
+    w, h = base.size
+    try:
+        logo, mask = watermark_logo(w)
+        base.paste(logo, (w - logo.width - int(w*0.03), h - logo.height - int(w*0.03)), mask)
+    except Exception as e: print(f"Erro Watermark: {e}")
+    return base
+
+# --- MARCA D'ÁGUA DE VÍDEO (ffmpeg direto, sem loop de frames em Python) ---
+VIDEO_WM_THREADS = os.getenv("VIDEO_WM_THREADS", "0")
+VIDEO_WM_PRESET = os.getenv("VIDEO_WM_PRESET", "veryfast")
+VIDEO_WM_TIMEOUT = int(os.getenv("VIDEO_WM_TIMEOUT", "300"))
+VIDEO_DEFAULT_HEIGHT = 720
+
+@lru_cache(maxsize=1)
+def ffmpeg_bin() -> str:
+    if os.getenv("FFMPEG_BINARY"): return os.getenv("FFMPEG_BINARY")
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def mp4_info(src: Union[bytes, str]):
+    """Lê os boxes de topo do MP4 (bytes ou caminho): (moov antes do mdat?, (largura, altura) do vídeo)."""
+    f = io.BytesIO(src) if isinstance(src, bytes) else open(src, "rb")
+    with f:
+        total = f.seek(0, 2)
+        pos, order, size = 0, [], None
+        while pos + 8 <= total:
+            f.seek(pos)
+            head = f.read(16)
+            box_len, kind = struct.unpack(">I4s", head[:8])
+            if box_len == 1: box_len = struct.unpack(">Q", head[8:16])[0]
+            elif box_len == 0: box_len = total - pos
+            order.append(kind)
+            if kind == b"moov":
+                f.seek(pos)
+                moov = f.read(box_len)
+                i = moov.find(b"tkhd")
+                while i != -1 and size is None:
+                    tkhd = moov[i - 4:i - 4 + struct.unpack(">I", moov[i - 4:i])[0]]
+                    w, h = struct.unpack(">II", tkhd[-8:])
+                    if w and h: size = (w >> 16, h >> 16)
+                    i = moov.find(b"tkhd", i + 4)
+            if box_len < 8: break
+            pos += box_len
+    streamable = b"moov" in order and (b"mdat" not in order or order.index(b"moov") < order.index(b"mdat"))
+    return streamable, size
+
+def video_logo_file(height: int) -> str:
+    """PNG do logo com 15% da altura do vídeo, gravado uma vez por resolução.
+    O arquivo é compartilhado entre processos: grava em nome temporário e troca com
+    os.replace (ninguém lê um PNG pela metade) e regrava se a limpeza do /tmp o apagou."""
+    lh = int(height * 0.15)
+    path = Path(tempfile.gettempdir()) / f"nastia_logo_{lh}.png"
+    if path.exists(): return str(path)
+    logo = LOGO.resize((int(lh * LOGO.width / LOGO.height), lh), Image.Resampling.LANCZOS)
+    fd, tmp = tempfile.mkstemp(prefix=f"nastia_logo_{lh}_", suffix=".png", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f: logo.save(f, "PNG")
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return str(path)
+
+def mp4_output(dst: Optional[str] = None) -> List[str]:
+    """Saída em arquivo (faststart) ou no stdout (MP4 fragmentado, que não precisa de seek)."""
+    if dst: return ["-movflags", "+faststart", "-f", "mp4", "-y", dst]
+    return ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+
+def run_ffmpeg(src: Union[bytes, str], args: List[str], inputs: List[str] = ()) -> bytes:
+    """Roda o ffmpeg com `src` (caminho, ou bytes via pipe quando possível) como entrada 0; devolve o stdout."""
+    path = None
+    try:
+        if isinstance(src, str):
+            source, stdin = src, None
+        elif mp4_info(src)[0]:
+            source, stdin = "pipe:0", src
+        else:
+            # moov no fim do arquivo: o demuxer precisa de seek, então vai por arquivo
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp:
+                tmp.write(src)
+                path = tmp.name
+            source, stdin = path, None
+        cmd = [ffmpeg_bin(), "-hide_banner", "-loglevel", "error", "-i", source]
+        for extra in inputs: cmd += ["-i", extra]
+        proc = subprocess.run(cmd + args, input=stdin, capture_output=True, timeout=VIDEO_WM_TIMEOUT)
+        if proc.returncode != 0:
+            raise Exception(proc.stderr.decode(errors="ignore").strip()[-500:])
+        return proc.stdout
+    finally:
+        if path and os.path.exists(path): os.remove(path)
+
+def apply_video_watermark(src: str, dst: str, plan: str) -> str:
+    """Grava em `dst` o vídeo com logo; devolve o caminho do vídeo final (`src` se não aplicar)."""
+    if plan in ["plus", "pro", "agency", "criação"]: return src
+    if LOGO is None: return src
+
+    size = mp4_info(src)[1]
+    logo_path = video_logo_file(size[1] if size else VIDEO_DEFAULT_HEIGHT)
+    try:
+        run_ffmpeg(src, ["-filter_complex", "[0:v][1:v]overlay=W-w-8:H-h-8[v]",
+                         "-map", "[v]", "-map", "0:a?", "-c:a", "copy",
+                         "-c:v", "libx264", "-preset", VIDEO_WM_PRESET, "-threads", VIDEO_WM_THREADS]
+                   + mp4_output(dst), inputs=[logo_path])
+        return dst
+    except Exception as e:
+        print(f"Erro Video Watermark: {e}")
+        return src
+
+# --- DERIVADOS DE VÍDEO (poster, prévia leve e escada de resoluções) ---
+VIDEO_PREVIEW_HEIGHT = int(os.getenv("VIDEO_PREVIEW_HEIGHT", "480"))
+VIDEO_PREVIEW_BITRATE = os.getenv("VIDEO_PREVIEW_BITRATE", "1M")
+VIDEO_PREVIEW_SECONDS = os.getenv("VIDEO_PREVIEW_SECONDS", "4")
+LADDER_BITRATES = {1080: "5M", 720: "2500k", 480: "1M", 360: "600k"}
+
+def video_poster(src: Union[bytes, str]) -> bytes:
+    return run_ffmpeg(src, ["-frames:v", "1", "-q:v", "3", "-f", "image2", "-c:v", "mjpeg", "pipe:1"])
+
+def video_rendition(src: Union[bytes, str], height: int, bitrate: str, seconds: Optional[str] = None,
+                    dst: Optional[str] = None) -> Union[bytes, str]:
+    args = ["-t", seconds, "-an"] if seconds else ["-map", "0:v", "-map", "0:a?", "-c:a", "copy"]
+    out = run_ffmpeg(src, args + ["-vf", f"scale=-2:'min(ih,{height})'", "-c:v", "libx264", "-preset", VIDEO_WM_PRESET,
+                                  "-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate,
+                                  "-threads", VIDEO_WM_THREADS] + mp4_output(dst))
+    return dst or out
+
+def video_preview(src: Union[bytes, str]) -> bytes:
+    return video_rendition(src, VIDEO_PREVIEW_HEIGHT, VIDEO_PREVIEW_BITRATE, VIDEO_PREVIEW_SECONDS)
+
+# Entradas do usuário: orientação EXIF aplicada, lado maior limitado ao que o modelo usa.
+# JPEG já dentro do limite passa direto; JPEG grande é reduzido no domínio DCT (draft).
+INPUT_MAX_EDGE = int(os.getenv("INPUT_MAX_EDGE", "2048"))
+INPUT_MAX_PIXELS = int(os.getenv("INPUT_MAX_PIXELS", "80000000"))
+
+class InputImageError(ValueError):
+    pass
+
+def normalize_input_image(data: bytes) -> bytes:
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise InputImageError("Imagem grande demais.")
+    except Exception:
+        raise InputImageError("Formato de imagem inválido.")
+    w, h = img.size
+    # Só o cabeçalho foi lido até aqui: bombas de descompressão param antes de decodificar
+    if w * h > INPUT_MAX_PIXELS:
+        raise InputImageError(f"Imagem grande demais ({w}x{h}).")
+    orientation = img.getexif().get(0x0112, 1)
+    if img.format == "JPEG" and img.mode == "RGB" and max(w, h) <= INPUT_MAX_EDGE and orientation == 1:
+        return data
+    if img.format == "JPEG" and max(w, h) > INPUT_MAX_EDGE:
+        scale = INPUT_MAX_EDGE / max(w, h)
+        img.draft("RGB", (int(w * scale + 1), int(h * scale + 1)))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if max(img.size) > INPUT_MAX_EDGE:
+        img.thumbnail((INPUT_MAX_EDGE, INPUT_MAX_EDGE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG")
+    return buf.getvalue()
+
+# Conjunto de saída gerado de uma só decodificação: master JPEG, versão web comprimida,
+# miniatura para a galeria e um LQIP minúsculo (data URI) para o placeholder.
+OUTPUT_WEB_FORMAT = os.getenv("OUTPUT_WEB_FORMAT", "WEBP").upper()
+OUTPUT_WEB_QUALITY = int(os.getenv("OUTPUT_WEB_QUALITY", "80"))
+THUMB_EDGE = int(os.getenv("THUMB_EDGE", "400"))
+LQIP_EDGE = 16
+WEB_FORMATS = {"WEBP": ("webp", "image/webp"), "AVIF": ("avif", "image/avif")}
+
+def encode(img: Image.Image, fmt: str, **params) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+def render_output_set(data: bytes, plan: str) -> dict:
+    final_img = apply_watermark(Image.open(io.BytesIO(data)), plan)
+    ext, content_type = WEB_FORMATS.get(OUTPUT_WEB_FORMAT, WEB_FORMATS["WEBP"])
+    thumb = final_img.copy()
+    thumb.thumbnail((THUMB_EDGE, THUMB_EDGE), Image.Resampling.LANCZOS)
+    lqip = thumb.copy()
+    lqip.thumbnail((LQIP_EDGE, LQIP_EDGE), Image.Resampling.BILINEAR)
+    return {
+        "master": (encode(final_img, "JPEG", quality=95), "jpg", "image/jpeg"),
+        "web": (encode(final_img, ext.upper(), quality=OUTPUT_WEB_QUALITY), ext, content_type),
+        "thumb": (encode(thumb, "WEBP", quality=70), "webp", "image/webp"),
+        "lqip": "data:image/webp;base64," + base64.b64encode(encode(lqip, "WEBP", quality=40)).decode(),
+    }
+
+def timed(fn, *args):
+    """Executa no worker e devolve (resultado, segundos gastos)."""
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t0
@@ -0,0 +1,109 @@
+# Métricas em memória no formato texto do Prometheus, sem dependência extra.
+# Contadores, gauges e histogramas com labels; render() gera o corpo de GET /metrics.
+# Gauges com `fn` são calculados na hora da coleta (filas, jobs, pools).
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Segundos: de um encode de miniatura (ms) até um render do Veo (minutos)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_registry: List["Metric"] = []
+
+def _fmt(value: float) -> str:
+    if value == float("inf"): return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values: Dict[tuple, object] = {}
+        _registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        """(sufixo, pares de label, valor) de cada série."""
+        with _lock:
+            return [("", tuple(zip(self.labels, k)), v) for k, v in self.values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        k = self.key(labels)
+        with _lock: self.values[k] = self.values.get(k, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 fn: Optional[Callable[[], Iterable[Tuple[dict, float]]]] = None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value: float, **labels):
+        k = self.key(labels)
+        with _lock: self.values[k] = value
+
+    def inc(self, amount: float = 1, **labels):
+        k = self.key(labels)
+        with _lock: self.values[k] = self.values.get(k, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.fn is None: return super().samples()
+        return [("", tuple(zip(self.labels, self.key(labels))), value) for labels, value in self.fn()]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        k = self.key(labels)
+        with _lock:
+            series = self.values.get(k)
+            if series is None: series = self.values[k] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        out = []
+        with _lock:
+            for k, (counts, total, count) in self.values.items():
+                pairs = tuple(zip(self.labels, k))
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    out.append(("_bucket", pairs + (("le", _fmt(bound)),), cumulative))
+                out += [("_bucket", pairs + (("le", "+Inf"),), count), ("_sum", pairs, total), ("_count", pairs, count)]
+        return out
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            print(f"Erro Métrica {metric.name}: {e}")
+            continue
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"]
+        for suffix, pairs, value in samples:
+            labels = ",".join(f'{n}="{_escape(v)}"' for n, v in pairs)
+            lines.append(f"{metric.name}{suffix}{{{labels}}} {_fmt(value)}" if labels else f"{metric.name}{suffix} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,180 @@
+# Camada de resiliência das chamadas externas (Gemini, Veo, Supabase):
+# retry com backoff exponencial + jitter, circuit breaker por dependência e
+# pedido "hedged" (segunda tentativa em paralelo quando a primeira passa do p95).
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+import metrics
+
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE = float(os.getenv("RETRY_BASE", "0.5"))
+RETRY_CAP = float(os.getenv("RETRY_CAP", "8"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Respostas em que o servidor certamente não executou o pedido: seguro repetir qualquer chamada.
+# As demais falhas transitórias só são repetidas em operações idempotentes.
+# 429 é cota/limite, não falha: nunca conta para o breaker, e dependências com
+# retry_quota=False (modelos, que já devolvem 429 ao cliente) nem repetem.
+QUOTA_STATUS = 429
+REJECTED_STATUS = {QUOTA_STATUS, 503}
+TRANSIENT_STATUS = {408, 500, 502, 504}
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, ConnectionRefusedError)
+NETWORK_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError, ConnectionError, TimeoutError)
+
+STATES = {"closed": 0, "half_open": 1, "open": 2}
+_breakers: Dict[str, "CircuitBreaker"] = {}
+
+RETRIES = metrics.Counter("nastia_retries_total", "Novas tentativas após falha transitória", ["dependency"])
+BREAKER_REJECTED = metrics.Counter("nastia_breaker_rejected_total", "Chamadas recusadas com o circuito aberto", ["dependency"])
+BREAKER_STATE = metrics.Gauge("nastia_breaker_state", "Estado do circuito (0 fechado, 1 meio-aberto, 2 aberto)", ["dependency"],
+                              fn=lambda: [({"dependency": b.name}, STATES[b.current()]) for b in list(_breakers.values())])
+HEDGES = metrics.Counter("nastia_hedged_requests_total", "Segundas tentativas disparadas e quem venceu", ["call", "winner"])
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} indisponível no momento (circuito aberto).")
+        self.name, self.retry_after = name, retry_after
+
+def status_of(e: BaseException) -> Optional[int]:
+    code = getattr(e, "code", None)
+    if isinstance(code, int): return code
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None) if isinstance(e, httpx.HTTPStatusError) else None
+
+def is_retryable(e: BaseException, idempotent: bool, quota: bool = True) -> bool:
+    if isinstance(e, CircuitOpen): return False
+    if status_of(e) == QUOTA_STATUS: return quota
+    if isinstance(e, CONNECT_ERRORS) or status_of(e) in REJECTED_STATUS: return True
+    return idempotent and (isinstance(e, NETWORK_ERRORS) or status_of(e) in TRANSIENT_STATUS)
+
+def backoff(attempt: int) -> float:
+    """Full jitter: sorteia entre 0 e o teto exponencial da tentativa."""
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+class CircuitBreaker:
+    """Abre após BREAKER_FAILURES falhas transitórias seguidas; depois de BREAKER_RESET s deixa passar uma sonda."""
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset: float = BREAKER_RESET,
+                 retry_quota: bool = True):
+        self.name, self.failures, self.reset, self.retry_quota = name, failures, reset, retry_quota
+        self.state = "closed"
+        self.count = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        _breakers[name] = self
+
+    def current(self) -> str:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset: return "half_open"
+        return self.state
+
+    def allow(self):
+        with self.lock:
+            state = self.current()
+            if state == "closed": return
+            if state == "half_open" and not self.probing:
+                self.state, self.probing = "half_open", True
+                return
+            BREAKER_REJECTED.inc(dependency=self.name)
+            raise CircuitOpen(self.name, max(1.0, self.reset - (time.monotonic() - self.opened_at)))
+
+    def record(self, ok: bool):
+        with self.lock:
+            self.probing = False
+            if ok:
+                self.state, self.count = "closed", 0
+                return
+            self.count += 1
+            if self.state == "half_open" or self.count >= self.failures:
+                if self.state != "open": print(f"Circuito {self.name} aberto após {self.count} falhas")
+                self.state, self.opened_at = "open", time.monotonic()
+
+    def outcome(self, e: Optional[BaseException]):
+        # Erros de negócio (saldo, validação) e cota (429) não dizem nada sobre a saúde da dependência
+        if e is None or (status_of(e) != QUOTA_STATUS and is_retryable(e, True)): self.record(e is None)
+        elif self.probing:
+            with self.lock: self.probing = False
+
+async def call_async(breaker: CircuitBreaker, factory: Callable[[], Awaitable], idempotent: bool = True,
+                     attempts: int = RETRY_ATTEMPTS):
+    """Executa `factory()` (uma corrotina nova por tentativa) com breaker e backoff."""
+    for attempt in range(attempts):
+        breaker.allow()
+        try:
+            result = await factory()
+        except asyncio.CancelledError as e:
+            breaker.outcome(e)  # libera a sonda do meio-aberto
+            raise
+        except Exception as e:
+            breaker.outcome(e)
+            if attempt + 1 >= attempts or not is_retryable(e, idempotent, breaker.retry_quota): raise
+            RETRIES.inc(dependency=breaker.name)
+            await asyncio.sleep(backoff(attempt))
+        else:
+            breaker.outcome(None)
+            return result
+
+def call_sync(breaker: CircuitBreaker, fn: Callable, idempotent: bool = True, attempts: int = RETRY_ATTEMPTS):
+    """Versão síncrona (para o que roda no pool de threads, como o client do Supabase)."""
+    for attempt in range(attempts):
+        breaker.allow()
+        try:
+            result = fn()
+        except Exception as e:
+            breaker.outcome(e)
+            if attempt + 1 >= attempts or not is_retryable(e, idempotent, breaker.retry_quota): raise
+            RETRIES.inc(dependency=breaker.name)
+            time.sleep(backoff(attempt))
+        else:
+            breaker.outcome(None)
+            return result
+
+class LatencyWindow:
+    """Últimas N latências de sucesso, para decidir quando vale disparar o hedge."""
+    def __init__(self, size: int = 200):
+        self.samples: deque = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.samples) < HEDGE_MIN_SAMPLES: return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def hedged(call: str, factory: Callable[[], Awaitable], delay: Optional[float],
+                 hedge: Optional[Callable[[], Optional[Awaitable]]] = None):
+    """Se a primeira tentativa não terminar em `delay` s, dispara outra e fica com a primeira que der certo.
+    `hedge` cria a segunda tentativa (padrão: `factory`); se devolver None, segue só com a primeira."""
+    first = asyncio.ensure_future(factory())
+    tasks = [first]
+    try:
+        if delay is None: return await first
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done: return first.result()
+        second = (hedge or factory)()
+        if second is None:
+            HEDGES.inc(call=call, winner="skipped")
+            return await first
+        tasks.append(asyncio.ensure_future(second))
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    HEDGES.inc(call=call, winner="hedge" if task is tasks[1] else "primary")
+                    return task.result()
+                error = task.exception()
+        HEDGES.inc(call=call, winner="none")
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done(): task.cancel()
@@ -0,0 +1,10 @@
+-- Sessões de chat persistidas (CHAT_SESSION_BACKEND=supabase).
+create table if not exists public.chat_sessions (
+    id text primary key,
+    data jsonb not null,
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists chat_sessions_updated_idx on public.chat_sessions (updated_at);
+
+alter table public.chat_sessions enable row level security;
@@ -0,0 +1,104 @@
+-- Ledger de créditos: reserva / confirmação / estorno, cada passo em uma única RPC.
+-- Aplicar no SQL Editor do Supabase. O backend usa a service key, então as funções
+-- ficam restritas a ela (security definer + revoke de public).
+
+create table if not exists public.credit_reservations (
+    id uuid primary key default gen_random_uuid(),
+    user_id uuid not null references public.profiles(id) on delete cascade,
+    amount integer not null check (amount > 0),
+    status text not null default 'reserved' check (status in ('reserved', 'committed', 'refunded')),
+    created_at timestamptz not null default now(),
+    settled_at timestamptz
+);
+
+-- Renovado pelo processo dono enquanto o job vive (fila, render, commit pendente).
+alter table public.credit_reservations add column if not exists heartbeat_at timestamptz not null default now();
+
+drop index if exists credit_reservations_pending_idx;
+create index if not exists credit_reservations_heartbeat_idx
+    on public.credit_reservations (heartbeat_at) where status = 'reserved';
+
+-- Debita e registra a reserva atomicamente. Falha se o saldo não cobrir o custo.
+create or replace function public.reserve_credits(p_user_id uuid, p_amount integer)
+returns table (reservation_id uuid, plan_tier text, credits integer)
+language plpgsql security definer set search_path = public as $$
+declare
+    v_plan text;
+    v_credits integer;
+begin
+    update profiles p set credits = p.credits - p_amount
+     where p.id = p_user_id and p.credits >= p_amount
+    returning p.plan_tier, p.credits into v_plan, v_credits;
+
+    if not found then
+        select p.credits into v_credits from profiles p where p.id = p_user_id;
+        if not found then
+            raise exception 'Usuário não encontrado.';
+        end if;
+        raise exception 'Saldo insuficiente. Necessário: %. Atual: %', p_amount, v_credits;
+    end if;
+
+    insert into credit_reservations (user_id, amount) values (p_user_id, p_amount)
+    returning id into reservation_id;
+    plan_tier := v_plan;
+    credits := v_credits;
+    return next;
+end $$;
+
+-- Confirma a cobrança depois que o resultado foi entregue.
+create or replace function public.commit_credits(p_reservation_id uuid)
+returns boolean
+language sql security definer set search_path = public as $$
+    update credit_reservations set status = 'committed', settled_at = now()
+     where id = p_reservation_id and status = 'reserved'
+    returning true;
+$$;
+
+-- Devolve os créditos de uma reserva ainda aberta (idempotente).
+create or replace function public.refund_credits(p_reservation_id uuid)
+returns boolean
+language sql security definer set search_path = public as $$
+    with r as (
+        update credit_reservations set status = 'refunded', settled_at = now()
+         where id = p_reservation_id and status = 'reserved'
+        returning user_id, amount
+    )
+    update profiles p set credits = p.credits + r.amount from r where p.id = r.user_id
+    returning true;
+$$;
+
+-- Heartbeat das reservas ainda abertas de um processo vivo.
+create or replace function public.touch_reservations(p_ids uuid[])
+returns integer
+language sql security definer set search_path = public as $$
+    with r as (
+        update credit_reservations set heartbeat_at = now()
+         where id = any(p_ids) and status = 'reserved'
+        returning 1
+    )
+    select count(*)::integer from r;
+$$;
+
+-- Varredura: estorna reservas sem heartbeat há muito tempo (processo morreu no meio do job).
+create or replace function public.release_stale_reservations(p_max_age_seconds integer)
+returns integer
+language sql security definer set search_path = public as $$
+    with r as (
+        update credit_reservations set status = 'refunded', settled_at = now()
+         where status = 'reserved' and heartbeat_at < now() - make_interval(secs => p_max_age_seconds)
+        returning user_id, amount
+    ), per_user as (
+        select user_id, sum(amount) as amount from r group by user_id
+    ), upd as (
+        update profiles p set credits = p.credits + per_user.amount
+          from per_user where p.id = per_user.user_id
+        returning 1
+    )
+    select count(*)::integer from r;
+$$;
+
+revoke all on function public.reserve_credits(uuid, integer) from public, anon, authenticated;
+revoke all on function public.commit_credits(uuid) from public, anon, authenticated;
+revoke all on function public.refund_credits(uuid) from public, anon, authenticated;
+revoke all on function public.touch_reservations(uuid[]) from public, anon, authenticated;
+revoke all on function public.release_stale_reservations(integer) from public, anon, authenticated;
@@ -0,0 +1,5 @@
+-- Renditions das imagens geradas: versão web (WebP/AVIF), miniatura da galeria e LQIP.
+alter table public.generations
+    add column if not exists web_url text,
+    add column if not exists thumb_url text,
+    add column if not exists lqip text;
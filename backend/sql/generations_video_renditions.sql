@@ -0,0 +1,8 @@
+-- Derivados dos vídeos: poster, prévia leve e escada opcional de resoluções ({"720": url, ...}).
+alter table public.generations
+    add column if not exists poster_url text,
+    add column if not exists preview_url text,
+    add column if not exists renditions jsonb;
+
+-- Os derivados chegam depois da linha e são gravados por url.
+create index if not exists generations_url_idx on public.generations (url);
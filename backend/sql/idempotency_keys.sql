@@ -0,0 +1,29 @@
+-- Idempotency-Key compartilhada entre workers (IDEMPOTENCY_BACKEND=supabase).
+-- response nula = requisição em andamento; expires_at vale IDEMPOTENCY_LOCK enquanto roda
+-- e IDEMPOTENCY_TTL depois de guardada a resposta.
+
+create table if not exists public.idempotency_keys (
+    key text primary key,
+    fingerprint text not null,
+    response jsonb,
+    expires_at timestamptz not null
+);
+
+alter table public.idempotency_keys enable row level security;
+
+-- Linhas vencidas são substituídas no claim e podem ser apagadas por um cron.
+
+-- Reserva a chave (sem linha de volta) ou devolve o registro existente.
+create or replace function public.idempotency_claim(p_key text, p_fingerprint text, p_lock_seconds double precision)
+returns table (o_fingerprint text, o_response jsonb)
+language plpgsql security definer set search_path = public as $$
+begin
+    delete from idempotency_keys where key = p_key and expires_at <= now();
+    insert into idempotency_keys (key, fingerprint, expires_at)
+    values (p_key, p_fingerprint, now() + make_interval(secs => p_lock_seconds))
+    on conflict (key) do nothing;
+    if found then return; end if;
+    return query select k.fingerprint, k.response from idempotency_keys k where k.key = p_key;
+end $$;
+
+revoke all on function public.idempotency_claim(text, text, double precision) from public, anon, authenticated;
@@ -0,0 +1,35 @@
+-- Token buckets compartilhados entre workers (RATE_LIMIT_BACKEND=supabase).
+-- Cada chamada consome um token numa única RPC; a linha fica travada durante o cálculo.
+
+create table if not exists public.rate_limits (
+    key text primary key,
+    tokens double precision not null,
+    updated_at timestamptz not null default now()
+);
+
+alter table public.rate_limits enable row level security;
+
+-- Linhas paradas há mais de um dia equivalem a baldes cheios e podem ser apagadas por um cron.
+
+-- Devolve 0 se o token foi consumido ou os segundos até o próximo token.
+create or replace function public.rate_limit_take(p_key text, p_per_minute double precision)
+returns double precision
+language plpgsql security definer set search_path = public as $$
+declare
+    v_rate double precision := p_per_minute / 60;
+    v_tokens double precision;
+begin
+    insert into rate_limits as r (key, tokens, updated_at) values (p_key, p_per_minute, now())
+    on conflict (key) do update
+       set tokens = least(p_per_minute, r.tokens + extract(epoch from now() - r.updated_at) * v_rate),
+           updated_at = now()
+    returning tokens into v_tokens;
+
+    if v_tokens >= 1 then
+        update rate_limits set tokens = v_tokens - 1 where key = p_key;
+        return 0;
+    end if;
+    return (1 - v_tokens) / v_rate;
+end $$;
+
+revoke all on function public.rate_limit_take(text, double precision) from public, anon, authenticated;
@@ -0,0 +1,11 @@
+-- Estado dos jobs de vídeo (JOB_BACKEND=supabase), para que qualquer worker responda GET /jobs/{id}.
+create table if not exists public.video_jobs (
+    id text primary key,
+    data jsonb not null,
+    updated_at timestamptz not null default now()
+);
+
+-- Jobs terminados há mais de um dia podem ser apagados por um cron.
+create index if not exists video_jobs_updated_idx on public.video_jobs (updated_at);
+
+alter table public.video_jobs enable row level security;
@@ -0,0 +1,91 @@
+"""Benchmark de cold start do backend.
+
+Roda `import main` + lifespan num processo novo com `-X importtime`, imprime o tempo
+cumulativo dos imports diretos do main e falha (exit 1) se passar do orçamento.
+
+    python startup_bench.py [--budget 1800] [--top 15]
+
+Orçamento padrão em STARTUP_BUDGET_MS. Sem .env, usa credenciais falsas (nada sai pela rede).
+
+Linha de base (Python 3.11, checkout limpo, 1 vCPU): total de 0,94 a 1,43 s, mediana ~1,0 s.
+O `import main` leva 0,7 a 1,05 s, quase tudo em google.genai (0,28-0,42 s), fastapi (0,21-0,34 s)
+e supabase (~0,11 s); o lifespan, ~0,15 s. O google.genai não dá para adiar: `types` é usado no
+módulo inteiro e importá-lo já carrega o pacote. O padrão de 1800 ms deixa folga para a variação
+entre execuções e ainda pega regressões como voltar a importar moviepy no topo (vários segundos).
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+HERE = Path(__file__).parent
+DEFAULT_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1800"))
+DUMMY_ENV = {
+    "SUPABASE_URL": "http://localhost:1",
+    "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.x",
+    "GEMINI_API_KEY": "x",
+}
+
+CHILD = """
+import asyncio, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+async def boot():
+    async with main.lifespan(main.app): pass
+asyncio.run(boot())
+t2 = time.perf_counter()
+print(f"{(t1 - t0) * 1000:.1f} {(t2 - t1) * 1000:.1f}")
+"""
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_breakdown(stderr: str):
+    """Imports diretos do main (cumulativo, ms), mais o próprio main."""
+    rows, total = [], 0.0
+    for line in stderr.splitlines():
+        m = LINE.match(line)
+        if not m: continue
+        cumulative, depth, name = int(m.group(2)) / 1000, len(m.group(3)) // 2, m.group(4)
+        if depth == 1: rows.append((name, cumulative))
+        elif depth == 0:
+            if name == "main": total = cumulative; break
+            rows = []  # imports do site/asyncio antes do main não contam
+    return total, sorted(rows, key=lambda r: -r[1])
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET_MS, help="ms para import + lifespan")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    for k, v in DUMMY_ENV.items(): env.setdefault(k, v)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD], cwd=HERE, env=env,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        print("Erro: backend não subiu")
+        return 2
+
+    import_ms, lifespan_ms = map(float, proc.stdout.split()[-2:])
+    total_import, rows = import_breakdown(proc.stderr)
+    print(f"{'módulo':<32}{'ms':>9}")
+    for name, ms in rows[:args.top]: print(f"{name:<32}{ms:>9.1f}")
+    print(f"{'import main (importtime)':<32}{total_import:>9.1f}")
+    print(f"{'import main (relógio)':<32}{import_ms:>9.1f}")
+    print(f"{'lifespan':<32}{lifespan_ms:>9.1f}")
+    total = import_ms + lifespan_ms
+    print(f"{'total':<32}{total:>9.1f}  (orçamento {args.budget:.0f} ms)")
+    if total > args.budget:
+        print(f"Erro: startup de {total:.0f} ms passou do orçamento de {args.budget:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,6 @@
+# Testes do backend: `pip install pytest` e, dentro de backend/, `python -m pytest -q`.
+# Nada sai pela rede: os clientes do Supabase/Gemini só são criados no lifespan.
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,58 @@
+# Orçamento de tokens da sessão de chat: count_tokens só perto do gatilho do resumo.
+import asyncio
+
+import pytest
+
+import main
+
+
+def session(*texts):
+    return {"summary": None, "summary_tokens": 0, "turns": [{"role": "user" if i % 2 == 0 else "model", "text": t}
+                                                            for i, t in enumerate(texts)]}
+
+
+def contents(monkeypatch, s):
+    counted = []
+    async def count_tokens(text):
+        counted.append(text)
+        return len(text)
+    monkeypatch.setattr(main, "count_tokens", count_tokens)
+    asyncio.run(main.session_contents(s))
+    return counted
+
+
+def test_short_sessions_are_only_estimated(monkeypatch):
+    monkeypatch.setattr(main, "CHAT_SUMMARY_TRIGGER", 100)
+    s = session("a" * 40, "b" * 40)
+    assert contents(monkeypatch, s) == []
+    assert all("tokens" not in t for t in s["turns"])
+
+
+def test_turns_are_counted_once_near_the_trigger(monkeypatch):
+    monkeypatch.setattr(main, "CHAT_SUMMARY_TRIGGER", 100)
+    s = session("a" * 200, "b" * 200)
+    s["turns"][1]["tokens"] = 50  # turno do modelo já veio com usage_metadata
+    assert contents(monkeypatch, s) == ["a" * 200]
+    assert [t["tokens"] for t in s["turns"]] == [200, 50]
+
+
+def test_missing_session_asks_for_the_client_history(monkeypatch):
+    monkeypatch.setattr(main, "chat_sessions", main.ChatSessions())
+    req = main.ChatRequest(persona="copy", session_id="sumiu", message="e agora?")
+    with pytest.raises(main.HTTPException) as e:
+        asyncio.run(main.open_chat_session(req))
+    assert e.value.status_code == 409
+    history = [{"role": "model", "parts": "Olá!"}, {"role": "user", "parts": "oi"}, {"role": "model", "parts": "tudo bem?"}]
+    s = asyncio.run(main.open_chat_session(main.ChatRequest(persona="copy", session_id="sumiu", message="e agora?", history=history)))
+    assert s["id"] != "sumiu"
+    assert [t["text"] for t in s["turns"]] == ["Olá!", "oi", "tudo bem?", "e agora?"]
+
+
+def test_known_session_ignores_the_history(monkeypatch):
+    sessions = main.ChatSessions()
+    monkeypatch.setattr(main, "chat_sessions", sessions)
+    first = asyncio.run(main.open_chat_session(main.ChatRequest(persona="copy", message="oi")))
+    asyncio.run(sessions.save(first))
+    again = asyncio.run(main.open_chat_session(main.ChatRequest(persona="copy", session_id=first["id"], message="de novo",
+                                                                history=[{"role": "user", "parts": "velho"}])))
+    assert [t["text"] for t in again["turns"]] == ["oi", "de novo"]
@@ -0,0 +1,53 @@
+# Spool do HistoryWriter: o que sobrou de um processo anterior volta uma única vez.
+import asyncio
+import json
+
+import main
+
+
+def spool_rows(path):
+    return [json.loads(line)["url"] for line in path.read_text().splitlines()]
+
+
+def start(writer):
+    async def scenario():
+        writer.start()
+        writer.closing = True  # só a recuperação interessa: não grava nada
+        writer.task.cancel()
+        await asyncio.gather(writer.task, return_exceptions=True)
+        if writer.lock: writer.lock.close()
+    asyncio.run(scenario())
+
+
+def test_restart_with_same_pid_reads_its_own_spool_once(tmp_path):
+    writer = main.HistoryWriter(tmp_path / "history_spool.jsonl")
+    writer.spool.write_text(json.dumps({"url": "a"}) + "\n")  # sobra do processo anterior com este pid
+    start(writer)
+    assert [row["url"] for row in writer.rows] == ["a"]
+    assert spool_rows(writer.spool) == ["a"]
+
+
+def test_adopts_orphan_and_legacy_spools(tmp_path):
+    base = tmp_path / "history_spool.jsonl"
+    base.write_text(json.dumps({"url": "legacy"}) + "\n")
+    (tmp_path / "history_spool.1.jsonl").write_text(json.dumps({"url": "orphan"}) + "\n" + '{"url": "cut')
+    writer = main.HistoryWriter(base)
+    start(writer)
+    assert sorted(row["url"] for row in writer.rows) == ["legacy", "orphan"]
+    assert sorted(p.name for p in tmp_path.glob("*.jsonl")) == [writer.spool.name]
+
+
+def test_amend_waits_for_the_row_insert(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "insert_history", lambda rows: calls.append(("insert", [r["url"] for r in rows])))
+    monkeypatch.setattr(main, "update_history", lambda url, fields: calls.append(("update", url, fields)))
+    writer = main.HistoryWriter(tmp_path / "history_spool.jsonl")
+
+    async def scenario():
+        writer.add({"url": "v"})
+        writer.amend("v", {"poster_url": "p"})
+        writer.amend("x", {"poster_url": "q"})  # linha já gravada em outra rodada
+        assert await writer.flush()
+    asyncio.run(scenario())
+    assert calls == [("insert", ["v"]), ("update", "v", {"poster_url": "p"}), ("update", "x", {"poster_url": "q"})]
+    assert writer.amends == {}
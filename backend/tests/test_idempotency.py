@@ -0,0 +1,153 @@
+# IdempotencyMiddleware com o store em memória: replay, corpo diferente e duplicatas simultâneas.
+import asyncio
+
+import main
+
+
+def request(body, key=b"k", content_type=b"application/json"):
+    return {"type": "http", "method": "POST", "path": "/redeem-coins",
+            "headers": [(b"idempotency-key", key), (b"x-user-id", b"u"), (b"content-type", content_type)]}, body
+
+
+class App:
+    def __init__(self, status=200, gate=None):
+        self.bodies, self.status, self.gate = [], status, gate
+
+    async def __call__(self, scope, receive, send):
+        self.bodies.append((await receive())["body"])
+        if self.gate: await self.gate.wait()
+        await send({"type": "http.response.start", "status": self.status, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def call(middleware, scope, body):
+    sent = []
+    async def receive(): return {"type": "http.request", "body": body, "more_body": False}
+    async def send(message): sent.append(message)
+    await middleware(scope, receive, send)
+    return sent[0]["status"], dict(sent[0]["headers"]).get(b"idempotent-replayed")
+
+
+def run(scenario):
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+
+
+def middleware(monkeypatch, app):
+    monkeypatch.setattr(main, "idempotency_store", main.MemoryIdempotencyStore())
+    return main.IdempotencyMiddleware(app)
+
+
+def test_same_key_replays_and_other_body_is_rejected(monkeypatch):
+    app = App()
+    m = middleware(monkeypatch, app)
+    async def scenario():
+        assert await call(m, *request(b"a")) == (200, None)
+        assert await call(m, *request(b"a")) == (200, b"true")
+        assert await call(m, *request(b"b")) == (422, None)
+        assert await call(m, *request(b"b", key=b"k2")) == (200, None)
+    run(scenario)
+    assert app.bodies == [b"a", b"b"]
+
+
+def test_multipart_boundary_is_not_part_of_the_fingerprint(monkeypatch):
+    app = App()
+    m = middleware(monkeypatch, app)
+    form = lambda b: (b"--" + b + b"\r\nuser_id=u\r\n--" + b + b"--", b"multipart/form-data; boundary=" + b)
+    async def scenario():
+        body, ctype = form(b"xyz")
+        assert await call(m, *request(body, content_type=ctype)) == (200, None)
+        body, ctype = form(b"abc")
+        assert await call(m, *request(body, content_type=ctype)) == (200, b"true")
+    run(scenario)
+    assert len(app.bodies) == 1
+
+
+def test_concurrent_duplicates_share_the_first_response(monkeypatch):
+    app = App(gate=asyncio.Event())
+    m = middleware(monkeypatch, app)
+    async def scenario():
+        first = asyncio.create_task(call(m, *request(b"a")))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(call(m, *request(b"a")))
+        await asyncio.sleep(0.01)
+        app.gate.set()
+        assert await first == (200, None)
+        assert await second == (200, b"true")
+    run(scenario)
+    assert app.bodies == [b"a"]
+
+
+def test_server_errors_are_not_stored(monkeypatch):
+    app = App(status=503)
+    m = middleware(monkeypatch, app)
+    async def scenario():
+        assert (await call(m, *request(b"a")))[0] == 503
+        assert (await call(m, *request(b"a")))[0] == 503
+    run(scenario)
+    assert len(app.bodies) == 2
+
+
+def test_oversized_body_is_rejected_without_reaching_the_app(monkeypatch):
+    app = App()
+    m = middleware(monkeypatch, app)
+    monkeypatch.setattr(main, "IDEMPOTENCY_BODY_MAX", 4)
+    async def scenario():
+        assert await call(m, *request(b"abcdef")) == (413, None)
+        assert await call(m, *request(b"abc")) == (200, None)
+    run(scenario)
+    assert app.bodies == [b"abc"]
+
+
+def test_runs_inside_rate_limit_and_admission():
+    order = [mw.cls for mw in main.app.user_middleware]  # do mais externo para o mais interno
+    assert order.index(main.RateLimitMiddleware) < order.index(main.AdmissionMiddleware) < order.index(main.IdempotencyMiddleware)
+
+
+class StreamingApp:
+    """Lê o corpo inteiro, em quantos pedaços vierem."""
+    def __init__(self):
+        self.bodies = []
+
+    async def __call__(self, scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"): break
+        self.bodies.append(b"".join(chunks))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+
+def multipart(boundary, files):
+    parts = [b"--" + boundary + b"\r\nContent-Disposition: form-data; name=\"files\"\r\n\r\n" + data + b"\r\n" for data in files]
+    return b"".join(parts) + b"--" + boundary + b"--\r\n", b"multipart/form-data; boundary=" + boundary
+
+
+def test_large_multi_file_body_is_streamed_to_the_route(monkeypatch):
+    app = StreamingApp()
+    m = middleware(monkeypatch, app)
+    files = [bytes([i]) * (9 * 1024 * 1024) for i in range(4)]  # 4 fotos de 9 MB
+    body, ctype = multipart(b"b0undary", files)
+    scope, _ = request(body, content_type=ctype)
+    async def scenario():
+        chunks = [body[i:i + 65531] for i in range(0, len(body), 65531)]  # boundaries cortados entre pedaços
+        async def receive():
+            chunk = chunks.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+        sent = []
+        async def send(message): sent.append(message)
+        await m(scope, receive, send)
+        return sent[0]["status"]
+    assert asyncio.run(scenario()) == 200
+    assert app.bodies == [body]
+
+
+def test_streamed_fingerprint_ignores_the_boundary_across_chunk_splits():
+    body, ctype = multipart(b"xyz123", [b"a" * 100, b"b" * 50])
+    other, other_ctype = multipart(b"qqq999", [b"a" * 100, b"b" * 50])
+    expected = main.body_fingerprint(other_ctype, other)
+    for size in (1, 3, 7, 64):
+        fingerprint = main.BodyFingerprint(ctype)
+        for i in range(0, len(body), size): fingerprint.update(body[i:i + size])
+        assert fingerprint.hexdigest() == expected
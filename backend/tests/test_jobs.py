@@ -0,0 +1,104 @@
+# Recuperação de jobs de vídeo órfãos e heartbeat dos jobs locais.
+import asyncio
+
+import main
+
+
+class Backend:
+    def __init__(self, rows):
+        self.rows, self.saved = rows, []
+
+    def orphans(self, idle):
+        return self.rows
+
+    def claim(self, row):
+        return True
+
+    def save(self, job):
+        self.saved.append(job)
+
+
+def row(status, **extra):
+    job = {"id": f"job-{status}", "status": status, "user_id": "u", "reservation": f"r-{status}",
+           "updated_at": 0, "error": None, **extra}
+    return {"data": job, "updated_at": "t"}
+
+
+def setup(monkeypatch, rows):
+    backend, refunded, adopted = Backend(rows), [], []
+    monkeypatch.setattr(main, "job_backend", backend)
+    monkeypatch.setattr(main, "jobs", {})
+    monkeypatch.setattr(main, "refund_credits", refunded.append)
+    monkeypatch.setattr(main.veo_poller, "add", lambda job, operation: adopted.append(job["id"]))
+    return backend, refunded, adopted
+
+
+def run(scenario):
+    async def wrapped():
+        await scenario()
+        await asyncio.gather(*main._job_tasks)  # escritas pendentes no backend
+    asyncio.run(asyncio.wait_for(wrapped(), 5))
+
+
+def test_orphans_without_operation_fail_and_refund(monkeypatch):
+    rows = [row("queued"), row("submitting"), row("running", operation="operations/1")]
+    backend, refunded, adopted = setup(monkeypatch, rows)
+    run(main.recover_video_jobs)
+    assert adopted == ["job-running"]
+    assert sorted(refunded) == ["r-queued", "r-submitting"]
+    assert {job["id"]: job["status"] for job in backend.saved} == {"job-queued": "error", "job-submitting": "error"}
+
+
+def test_heartbeat_renews_only_unfinished_local_jobs(monkeypatch):
+    backend, _, _ = setup(monkeypatch, [])
+    for status in ("queued", "submitting", "running", "done", "error"):
+        main.jobs[status] = {"id": status, "status": status, "updated_at": 0}
+    async def scenario(): main.heartbeat_jobs()
+    run(scenario)
+    assert sorted(job["id"] for job in backend.saved) == ["queued", "running", "submitting"]
+
+
+class QuotaError(Exception):
+    code = 429
+
+
+def video_setup(monkeypatch, answers):
+    gate = main.ModelGate(main.VIDEO_MODEL)
+    gate.limit = gate.free = 1
+    monkeypatch.setitem(main._model_gates, main.VIDEO_MODEL, gate)
+    monkeypatch.setattr(main, "job_backend", None)
+    monkeypatch.setattr(main, "VIDEO_QUOTA_BACKOFF", 0)
+    monkeypatch.setattr(main, "refund_credits", lambda reservation: None)
+    async def generate_videos(**kwargs):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception): raise answer
+        return answer
+    models = type("Models", (), {"generate_videos": staticmethod(generate_videos)})
+    monkeypatch.setattr(main, "client", type("Client", (), {"aio": type("Aio", (), {"models": models})})())
+    added = []
+    monkeypatch.setattr(main.veo_poller, "add", lambda job, operation, done=None: added.append((job, done)))
+    return gate, added
+
+
+def video_job():
+    return {"id": "v", "plan": "free", "user_id": "u", "status": "queued", "reservation": "r", "updated_at": 0, "error": None}
+
+
+def test_video_slot_is_held_until_the_render_ends(monkeypatch):
+    gate, added = video_setup(monkeypatch, ["operations/1"])
+    gate.hold()
+    asyncio.run(main.submit_video_job(video_job(), {}))
+    (job, done), = added
+    assert gate.free == 0 and gate.admitted == 1  # render em andamento ocupa a vaga
+    done()
+    assert gate.free == 1 and gate.admitted == 0
+
+
+def test_quota_429_puts_the_video_back_in_the_queue(monkeypatch):
+    gate, added = video_setup(monkeypatch, [QuotaError("quota"), "operations/1"])
+    gate.hold()
+    job = video_job()
+    asyncio.run(main.submit_video_job(job, {}))
+    assert job["status"] != "error" and len(added) == 1
+    added[0][1]()
+    assert gate.free == 1 and gate.admitted == 0
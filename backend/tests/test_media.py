@@ -0,0 +1,37 @@
+# Leitura dos boxes de topo do MP4 (mp4_info).
+import struct
+
+import media
+
+
+def box(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def tkhd(width: int, height: int) -> bytes:
+    # tkhd versão 0: largura e altura em ponto fixo 16.16 nos últimos 8 bytes
+    return box(b"tkhd", b"\0" * 76 + struct.pack(">II", width << 16, height << 16))
+
+
+MOOV = box(b"moov", box(b"trak", tkhd(0, 0)) + box(b"trak", tkhd(1280, 720)))  # áudio, depois vídeo
+FTYP = box(b"ftyp", b"isom\0\0\0\0")
+MDAT = box(b"mdat", b"\0" * 64)
+
+
+def test_faststart_file_is_streamable_and_reports_the_video_size():
+    assert media.mp4_info(FTYP + MOOV + MDAT) == (True, (1280, 720))
+
+
+def test_moov_after_mdat_is_not_streamable():
+    assert media.mp4_info(FTYP + MDAT + MOOV) == (False, (1280, 720))
+
+
+def test_file_without_moov():
+    assert media.mp4_info(FTYP + MDAT) == (False, None)
+
+
+def test_reads_from_a_path_and_64_bit_box_sizes(tmp_path):
+    large = struct.pack(">I4sQ", 1, b"mdat", 16 + 32) + b"\0" * 32
+    path = tmp_path / "video.mp4"
+    path.write_bytes(FTYP + large + MOOV)
+    assert media.mp4_info(str(path)) == (False, (1280, 720))
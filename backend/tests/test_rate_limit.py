@@ -0,0 +1,95 @@
+# Token bucket em memória (MemoryRateStore) e as regras do RateLimiter.
+import asyncio
+
+import pytest
+
+import main
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def take(store, key, per_minute):
+    return asyncio.run(store.take(key, per_minute))
+
+
+def test_bucket_allows_a_burst_then_refills_at_the_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    store = main.MemoryRateStore()
+    assert [take(store, "k", 6) for _ in range(6)] == [0.0] * 6
+    assert take(store, "k", 6) == 10.0  # 6/min: um token a cada 10 s
+    clock.now += 5
+    assert take(store, "k", 6) == 5.0
+    clock.now += 5
+    assert take(store, "k", 6) == 0.0
+
+
+def test_bucket_never_holds_more_than_its_size(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    store = main.MemoryRateStore()
+    take(store, "k", 2)
+    clock.now += 3600
+    assert [take(store, "k", 2) for _ in range(3)] == [0.0, 0.0, 30.0]
+
+
+def test_store_forgets_the_oldest_keys_past_the_cap(monkeypatch):
+    monkeypatch.setattr(main, "RATE_LIMIT_KEYS_MAX", 2)
+    store = main.MemoryRateStore()
+    for key in ("a", "b", "c"): take(store, key, 1)
+    assert list(store.buckets) == ["b", "c"]
+
+
+def test_requests_without_user_share_a_strict_bucket_per_ip(monkeypatch):
+    monkeypatch.setattr(main.time, "monotonic", Clock())
+    limiter = main.RateLimiter(main.MemoryRateStore())
+    check = lambda user, ip: asyncio.run(limiter.check("generate", user, ip))
+    anon = main.RATE_LIMIT_ANON["generate"]
+    assert all(check("", "1.1.1.1") == 0 for _ in range(int(anon)))
+    assert check("", "1.1.1.1") > 0
+    assert check("", "2.2.2.2") == 0
+    assert check("user", "1.1.1.1") == 0
+
+
+def test_client_ip_uses_the_trusted_forwarded_hop(monkeypatch):
+    scope = {"client": ("10.0.0.1", 1234)}
+    headers = {b"x-forwarded-for": b"6.6.6.6, 1.2.3.4"}
+    assert main.client_ip(scope, headers) == "10.0.0.1"
+    monkeypatch.setattr(main, "RATE_LIMIT_TRUSTED_HOPS", 1)
+    assert main.client_ip(scope, headers) == "1.2.3.4"
+    assert main.client_ip(scope, {}) == "10.0.0.1"
+
+
+def test_header_must_match_the_user_in_the_body():
+    main.check_user_header(None, "u")  # sem header: balde anônimo, já mais apertado
+    main.check_user_header("u", "u")
+    with pytest.raises(main.HTTPException) as e:
+        main.check_user_header("outro", "u")
+    assert e.value.status_code == 403
+
+
+
+def test_chat_user_must_match_the_header_and_exist(monkeypatch):
+    monkeypatch.setattr(main, "_plan_cache", main.OrderedDict(known="pro"))
+    monkeypatch.setattr(main, "load_plan", lambda user_id: main._plan_cache.get(user_id))
+    check = lambda user_id, header: asyncio.run(main.check_chat_user(main.ChatRequest(persona="copy", user_id=user_id), header))
+    check("known", "known")
+    check(None, None)  # anônimo: fica no balde do IP
+    for user_id, header in (("random", "random"), (None, "random"), ("known", "outro")):
+        with pytest.raises(main.HTTPException) as e:
+            check(user_id, header)
+        assert e.value.status_code == 403
+
+
+def test_forwarded_header_without_trusted_hops_warns_once(monkeypatch, capsys):
+    monkeypatch.setattr(main, "_proxy_warned", False)
+    headers = {b"x-forwarded-for": b"6.6.6.6"}
+    assert main.client_ip({"client": ("10.0.0.1", 1)}, headers) == "10.0.0.1"
+    main.client_ip({"client": ("10.0.0.1", 1)}, headers)
+    assert capsys.readouterr().out.count("AVISO Rate Limit") == 1
@@ -0,0 +1,100 @@
+# Circuit breaker e retry de resilience.py.
+import asyncio
+
+import pytest
+
+import resilience
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StatusError(Exception):
+    def __init__(self, code):
+        super().__init__(f"status {code}")
+        self.code = code
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock)
+    monkeypatch.setattr(resilience, "backoff", lambda attempt: 0)
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = resilience.CircuitBreaker("test-open", failures=3, reset=30)
+    for _ in range(2): breaker.outcome(StatusError(503))
+    breaker.outcome(None)  # sucesso zera a contagem
+    for _ in range(2): breaker.outcome(StatusError(503))
+    assert breaker.current() == "closed"
+    breaker.outcome(StatusError(503))
+    assert breaker.current() == "open"
+    with pytest.raises(resilience.CircuitOpen):
+        breaker.allow()
+
+
+def test_half_open_lets_a_single_probe_through(clock):
+    breaker = resilience.CircuitBreaker("test-probe", failures=1, reset=30)
+    breaker.outcome(StatusError(503))
+    clock.now += 30
+    assert breaker.current() == "half_open"
+    breaker.allow()
+    with pytest.raises(resilience.CircuitOpen):
+        breaker.allow()
+    breaker.outcome(StatusError(503))  # sonda falhou: abre de novo
+    assert breaker.current() == "open"
+    clock.now += 30
+    breaker.allow()
+    breaker.outcome(None)
+    assert breaker.current() == "closed"
+
+
+def test_quota_and_business_errors_do_not_count(clock):
+    breaker = resilience.CircuitBreaker("test-quota", failures=2, reset=30)
+    for _ in range(5):
+        breaker.outcome(StatusError(429))
+        breaker.outcome(ValueError("Saldo insuficiente"))
+    assert breaker.current() == "closed"
+
+
+def test_retries_transient_errors_but_sheds_quota_on_model_breakers(clock):
+    calls = []
+    async def failing(code):
+        calls.append(code)
+        raise StatusError(code)
+    model = resilience.CircuitBreaker("test-model", failures=100, retry_quota=False)
+    with pytest.raises(StatusError):
+        asyncio.run(resilience.call_async(model, lambda: failing(429), attempts=3))
+    assert calls == [429]
+    calls.clear()
+    with pytest.raises(StatusError):
+        asyncio.run(resilience.call_async(model, lambda: failing(503), attempts=3))
+    assert calls == [503] * 3
+
+
+def test_non_idempotent_calls_only_retry_rejected_requests(clock):
+    calls = []
+    def failing(code):
+        calls.append(code)
+        raise StatusError(code)
+    breaker = resilience.CircuitBreaker("test-write", failures=100)
+    with pytest.raises(StatusError):
+        resilience.call_sync(breaker, lambda: failing(500), idempotent=False, attempts=3)
+    assert calls == [500]
+
+
+def test_hedge_is_skipped_when_the_factory_declines():
+    calls = []
+    async def slow():
+        calls.append("primary")
+        await asyncio.sleep(0.05)
+        return "primary"
+    result = asyncio.run(resilience.hedged("test-skip", slow, 0.01, hedge=lambda: None))
+    assert result == "primary" and calls == ["primary"]
@@ -0,0 +1,167 @@
+# Fila de prioridade do ModelGate: peso por plano, rodízio entre usuários e cancelamento.
+import asyncio
+
+import main
+
+
+def make_gate(limit: int = 1) -> main.ModelGate:
+    gate = main.ModelGate("test-model")
+    gate.limit = gate.free = limit
+    return gate
+
+
+def run(scenario):
+    # Vaga perdida faz algum waiter esperar para sempre: falha em vez de travar a suíte
+    return asyncio.run(asyncio.wait_for(scenario, timeout=5))
+
+
+async def waiter(gate, plan, user, tag, served):
+    await gate.acquire(plan, user, {"tag": tag})
+    served.append(tag)
+
+
+async def drain(gate, served, releases):
+    for _ in range(releases):
+        gate.release()
+        await asyncio.sleep(0)
+    return served
+
+
+def test_heavier_lane_is_served_in_proportion_to_its_weight():
+    async def scenario():
+        gate, served = make_gate(), []
+        await gate.acquire("free", "holder")  # ocupa a única vaga
+        tasks = [asyncio.create_task(waiter(gate, "free", f"f{i}", f"free{i}", served)) for i in range(8)]
+        tasks += [asyncio.create_task(waiter(gate, "pro", f"p{i}", f"pro{i}", served)) for i in range(8)]
+        await asyncio.sleep(0)
+        await drain(gate, served, 10)
+        for task in tasks: task.cancel()
+        return served
+
+    served = run(scenario())
+    lanes = [tag.rstrip("0123456789") for tag in served]
+    # pro tem peso 4: a cada rodada de 5 atendimentos, 4 são do pro e 1 do free
+    assert lanes[:5].count("pro") == 4
+    assert lanes[:10].count("free") == 2
+
+
+def test_position_matches_service_order():
+    async def scenario():
+        gate, served, tickets = make_gate(), [], {}
+        await gate.acquire("free", "holder")
+        async def tracked(plan, user, tag):
+            tickets[tag] = {"tag": tag}
+            await gate.acquire(plan, user, tickets[tag])
+            served.append(tag)
+        specs = [("free", "a", "a0"), ("free", "a", "a1"), ("free", "b", "b0"), ("pro", "c", "c0"), ("agency", "d", "d0")]
+        tasks = [asyncio.create_task(tracked(*spec)) for spec in specs]
+        await asyncio.sleep(0)
+        predicted = sorted(tickets, key=lambda tag: gate.position(tickets[tag]))
+        await drain(gate, served, len(specs))
+        await asyncio.gather(*tasks)
+        return predicted, served
+
+    predicted, served = run(scenario())
+    assert predicted == served
+    # Mesmo usuário não passa na frente de outro do mesmo plano
+    assert served.index("b0") < served.index("a1")
+
+
+def test_free_lane_is_not_starved_by_a_busy_paid_lane():
+    async def scenario():
+        gate, served = make_gate(), []
+        await gate.acquire("free", "holder")
+        tasks = [asyncio.create_task(waiter(gate, "free", "f", "free", served))]
+        tasks += [asyncio.create_task(waiter(gate, "agency", f"x{i}", f"agency{i}", served)) for i in range(2)]
+        await asyncio.sleep(0)
+        n = 2
+        for _ in range(30):
+            gate.release()
+            await asyncio.sleep(0)
+            if "free" in served: break
+            # O plano pago nunca esvazia: chega um novo pedido a cada atendimento
+            tasks.append(asyncio.create_task(waiter(gate, "agency", f"x{n}", f"agency{n}", served)))
+            n += 1
+            await asyncio.sleep(0)
+        for task in tasks: task.cancel()
+        return served
+
+    served = run(scenario())
+    assert "free" in served
+    # agency tem peso 8: o free espera no máximo uma rodada completa do agency
+    assert served.index("free") <= main.PLAN_WEIGHTS["agency"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        gate, served = make_gate(), []
+        await gate.acquire("free", "holder")
+        first = asyncio.create_task(waiter(gate, "free", "a", "a", served))
+        second = asyncio.create_task(waiter(gate, "free", "b", "b", served))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        waiting = gate.waiting()
+        await drain(gate, served, 1)
+        await second
+        return waiting, served, gate
+
+    waiting, served, gate = run(scenario())
+    assert waiting == 1
+    assert served == ["b"]
+    gate.release()
+    assert gate.free == 1 and gate.waiting() == 0
+
+
+def test_cancelled_waiter_hands_over_a_slot_it_already_received():
+    async def scenario():
+        gate, served = make_gate(), []
+        await gate.acquire("free", "holder")
+        first = asyncio.create_task(waiter(gate, "free", "a", "a", served))
+        second = asyncio.create_task(waiter(gate, "free", "b", "b", served))
+        await asyncio.sleep(0)
+        gate.release()  # a vaga vai para "a"...
+        first.cancel()  # ...que é cancelado antes de rodar
+        await asyncio.gather(first, return_exceptions=True)
+        await second
+        return served, gate
+
+    served, gate = run(scenario())
+    assert served == ["b"]
+    gate.release()
+    assert gate.free == 1 and gate.waiting() == 0
+
+
+def test_release_skips_a_waiter_cancelled_before_it_resumed():
+    async def scenario():
+        gate, served = make_gate(), []
+        await gate.acquire("free", "holder")
+        queued = asyncio.create_task(waiter(gate, "free", "a", "a", served))
+        await asyncio.sleep(0)
+        queued.cancel()  # o future do waiter é cancelado já, mas ele só sai da fila quando a tarefa rodar
+        gate.release()
+        await asyncio.gather(queued, return_exceptions=True)
+        return served, gate
+
+    served, gate = run(scenario())
+    assert served == []
+    assert gate.free == 1 and gate.waiting() == 0
+
+
+def test_hedge_only_runs_in_a_free_slot_and_gives_it_back(monkeypatch):
+    async def scenario():
+        gate = make_gate(limit=2)
+        monkeypatch.setitem(main._model_gates, "test-model", gate)
+        await gate.acquire("free", "holder")
+        started = asyncio.Event()
+        async def call(): started.set(); await asyncio.sleep(10)
+        hedge = main.spare_slot_call("test-model", call)
+        await started.wait()
+        during = (gate.free, gate.running, main.spare_slot_call("test-model", call))
+        hedge.cancel()
+        await asyncio.gather(hedge, return_exceptions=True)
+        return during, gate
+
+    (free, running, second), gate = run(scenario())
+    assert (free, running, second) == (0, 1, None)  # sem vaga livre, não há segundo hedge
+    assert gate.free == 1 and gate.running == 0
@@ -70,6 +70,10 @@ export default function Home() {
     const [isReferralOpen, setIsReferralOpen] = useState(false); // NOVO ESTADO
 
     const fileInputRef = useRef<HTMLInputElement>(null);
+    // Uma chave por pedido do usuário: reenvios após falha de rede reaproveitam a mesma
+    // (o backend devolve o resultado já gerado em vez de cobrar de novo). Muda junto com o pedido.
+    const idempotencyKeyRef = useRef<string | null>(null);
+    useEffect(() => { idempotencyKeyRef.current = null; }, [mode, prompt, imageFiles, aspectRatio]);
 
     useEffect(() => {
         const check = () => setIsMobile(window.innerWidth < 768);
@@ -98,7 +102,7 @@ export default function Home() {
         fetchNotifications();
         const savedRef = localStorage.getItem("nastia_referrer");
         if (savedRef) {
-            try { await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/track-referral`, { user_id: session.user.id, referral_code: savedRef }); localStorage.removeItem("nastia_referrer"); } catch (e) { }
+            try { await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/track-referral`, { user_id: session.user.id, referral_code: savedRef }, { headers: { "X-User-Id": session.user.id } }); localStorage.removeItem("nastia_referrer"); } catch (e) { }
         }
     };
 
@@ -127,13 +131,18 @@ export default function Home() {
 
     const prepareAd = () => { const list = mode === "image" ? SHORT_ADS : LONG_ADS; setCurrentAdUrl(list[Math.floor(Math.random() * list.length)]); setAdProgress(0); };
 
-    // Função Auxiliar para converter Blob em Base64
-    const blobToBase64 = (blob: Blob): Promise<string> => {
-        return new Promise((resolve, _) => {
-            const reader = new FileReader();
-            reader.onloadend = () => resolve(reader.result as string);
-            reader.readAsDataURL(blob);
-        });
+    // Vídeos rodam como job no backend: consulta o status até o render terminar
+    // Fila (até 10 min) + render (até 15 min) + folga; depois disso o vídeo aparece no histórico se terminar
+    const JOB_WAIT_LIMIT_MS = 30 * 60 * 1000;
+    const waitForJob = async (jobId: string): Promise<string> => {
+        const deadline = Date.now() + JOB_WAIT_LIMIT_MS;
+        while (Date.now() < deadline) {
+            await new Promise(r => setTimeout(r, 5000));
+            const { data } = await axios.get(`${process.env.NEXT_PUBLIC_API_URL}/jobs/${jobId}`);
+            if (data.status === "done") return data.url;
+            if (data.status === "error") throw { response: { data: { detail: data.error } } };
+        }
+        throw { response: { data: { detail: "O vídeo está demorando mais que o esperado. Confira o histórico em alguns minutos." } } };
     };
 
     const handleGenerate = async () => {
@@ -165,29 +174,27 @@ export default function Home() {
                 if (imageFiles.length > 0) {
                     imageFiles.forEach(file => formData.append("files", file));
                 } else if (previousResult && isEditingContext) {
-                    try {
-                        const res = await fetch(previousResult);
-                        const blob = await res.blob();
-                        const base64Data = await blobToBase64(blob);
-                        formData.append("from_image", base64Data);
-                    } catch (e) {
-                        console.error("Erro ao preparar imagem de contexto", e);
-                    }
+                    // O backend busca a imagem anterior pela chave no storage (sem reenviar os bytes)
+                    formData.append("source_key", previousResult.split("/").pop() || "");
                 }
             } else {
                 if (imageFiles.length > 0) formData.append("file_start", imageFiles[0]);
             }
 
             const endpoint = mode === "image" ? `${process.env.NEXT_PUBLIC_API_URL}/generate-image` : `${process.env.NEXT_PUBLIC_API_URL}/generate-video`;
-            const res = await axios.post(endpoint, formData, { headers: { "Content-Type": "multipart/form-data" } });
+            if (!idempotencyKeyRef.current) idempotencyKeyRef.current = crypto.randomUUID();
+            const res = await axios.post(endpoint, formData, { headers: { "Content-Type": "multipart/form-data", "X-User-Id": session.user.id, "Idempotency-Key": idempotencyKeyRef.current } });
+            idempotencyKeyRef.current = null;
 
             fetchProfile(session.user.id);
-            fetchHistory(session.user.id);
 
-            const url = res.data.image || res.data.video;
+            const url = res.data.job_id ? await waitForJob(res.data.job_id) : res.data.image;
+            fetchHistory(session.user.id);
             if (mode === "video") { setResultUrl(url); setLoading(false); } else { setPendingResult(url); }
 
         } catch (error: any) {
+            // O servidor respondeu: a próxima tentativa é um pedido novo. Sem resposta, mantém a chave.
+            if (error.response) idempotencyKeyRef.current = null;
             alert(error.response?.data?.detail || "Erro ao processar.");
             setLoading(false);
             if (mode === "image") setResultUrl(previousResult);
@@ -406,7 +413,7 @@ export default function Home() {
                             <div className="grid grid-cols-2 md:grid-cols-3 gap-4">
                                 {history.map((item) => (
                                     <div key={item.id} className="aspect-square bg-gray-900 rounded-xl overflow-hidden border border-gray-800 relative group">
-                                        {item.type === 'image' ? <img src={item.url} className="w-full h-full object-cover" loading="lazy" /> : <video src={item.url} className="w-full h-full object-cover" muted />}
+                                        {item.type === 'image' ? <img src={item.thumb_url || item.url} style={item.lqip ? { backgroundImage: `url(${item.lqip})`, backgroundSize: "cover" } : undefined} className="w-full h-full object-cover" loading="lazy" /> : <video src={item.preview_url || item.url} poster={item.poster_url} preload={item.poster_url ? "none" : "metadata"} className="w-full h-full object-cover" muted />}
                                         <div className="absolute inset-0 bg-black/80 opacity-0 group-hover:opacity-100 transition-opacity flex flex-col items-center justify-center gap-2 p-2">
                                             <div className="flex gap-2">
                                                 <button onClick={() => handleDownload(item.url, item.type)} className="p-2 bg-white text-black rounded-full hover:scale-110 transition-transform"><Download className="w-4 h-4" /></button>
@@ -437,7 +444,7 @@ export default function Home() {
                     {referralCode && <div onClick={copyReferral} className="flex items-center gap-2 bg-gray-900 px-3 py-1 rounded-full border border-gray-800 cursor-pointer hover:border-yellow-500/50 transition-colors group"><Gift className="w-3 h-3 text-yellow-500" /><span className="text-xs group-hover:text-white">Indique e Ganhe: {referralCode}</span><Copy className="w-3 h-3 opacity-0 group-hover:opacity-100 transition-opacity" /></div>}
                 </div>
             </footer>
-            <ChatWidget onApplyPrompt={(text) => { setPrompt(text); window.scrollTo({ top: 0, behavior: 'smooth' }); }} />
+            <ChatWidget userId={session.user.id} onApplyPrompt={(text) => { setPrompt(text); window.scrollTo({ top: 0, behavior: 'smooth' }); }} />
         </main>
     );
 }
\ No newline at end of file
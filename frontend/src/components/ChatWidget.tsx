@@ -1,10 +1,9 @@
 "use client";
 
 import React, { useState, useRef, useEffect } from "react";
-import axios from "axios";
 import { MessageCircle, X, Send, Sparkles, User, Bot, Copy, ArrowUpRight, Info } from "lucide-react";
 
-interface ChatWidgetProps { onApplyPrompt: (text: string) => void; }
+interface ChatWidgetProps { onApplyPrompt: (text: string) => void; userId?: string; }
 type Message = { role: "user" | "model"; text: string; };
 
 const PERSONAS = [
@@ -16,12 +15,13 @@ const PERSONAS = [
     { id: "vendas", name: "💰 Vendas", desc: "Funis de venda e conversão." },
 ];
 
-export default function ChatWidget({ onApplyPrompt }: ChatWidgetProps) {
+export default function ChatWidget({ onApplyPrompt, userId }: ChatWidgetProps) {
     const [isOpen, setIsOpen] = useState(false);
     const [persona, setPersona] = useState("criativo");
     const [messages, setMessages] = useState<Message[]>([{ role: "model", text: "Olá! Escolha um especialista acima e vamos trabalhar!" }]);
     const [input, setInput] = useState("");
     const [loading, setLoading] = useState(false);
+    const [sessionId, setSessionId] = useState<string | null>(null);
     const scrollRef = useRef<HTMLDivElement>(null);
 
     useEffect(() => { if (scrollRef.current) scrollRef.current.scrollTop = scrollRef.current.scrollHeight; }, [messages]);
@@ -29,15 +29,44 @@ export default function ChatWidget({ onApplyPrompt }: ChatWidgetProps) {
     const handleSend = async () => {
         if (!input.trim()) return;
         const userMsg = { role: "user" as const, text: input };
+        const history = messages.map(m => ({ role: m.role, parts: m.text }));
         setMessages(prev => [...prev, userMsg]);
         setInput(""); setLoading(true);
         try {
-            const historyPayload = messages.concat(userMsg).map(m => ({ role: m.role, parts: m.text }));
-            const res = await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/chat`, { history: historyPayload, persona: persona });
-            setMessages(prev => [...prev, { role: "model", text: res.data.response }]);
+            // O histórico fica no servidor: manda só a sessão e a mensagem nova.
+            // Sessão perdida lá (expirou, outro worker): recomeça a partir da conversa local.
+            if (!(await streamChat({ session_id: sessionId, message: userMsg.text, persona: persona, user_id: userId })))
+                await streamChat({ message: userMsg.text, history, persona: persona, user_id: userId });
         } catch (error) { setMessages(prev => [...prev, { role: "model", text: "Erro de conexão. Tente novamente." }]); } finally { setLoading(false); }
     };
 
+    // Resposta via SSE: cada trecho vai sendo anexado à última mensagem do modelo
+    // Devolve false quando o servidor não tem mais a sessão (409)
+    const streamChat = async (payload: object): Promise<boolean> => {
+        const res = await fetch(`${process.env.NEXT_PUBLIC_API_URL}/chat/stream`, { method: "POST", headers: { "Content-Type": "application/json", ...(userId ? { "X-User-Id": userId } : {}) }, body: JSON.stringify(payload) });
+        if (res.status === 409) return false;
+        if (!res.ok || !res.body) throw new Error("chat");
+        const reader = res.body.getReader(); const decoder = new TextDecoder();
+        let buffer = ""; let started = false;
+        const setModelText = (text: string) => setMessages(prev => started ? [...prev.slice(0, -1), { role: "model", text }] : [...prev, { role: "model", text }]);
+        let text = "";
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split("\n\n"); buffer = events.pop() || "";
+            for (const evt of events) {
+                const type = evt.match(/^event: (.*)$/m)?.[1];
+                const data = JSON.parse(evt.match(/^data: (.*)$/m)?.[1] || "{}");
+                if (type === "error") throw new Error(data.detail);
+                if (type === "session") { setSessionId(data.session_id); continue; }
+                text = type === "done" ? data.response : text + (data.text || "");
+                setModelText(text); started = true; setLoading(false);
+            }
+        }
+        return true;
+    };
+
     const extractPrompt = (text: string) => { const parts = text.split("PROMPT:"); return parts.length > 1 ? parts[1].trim() : text; };
     const hasPrompt = (text: string) => text.includes("PROMPT:");
     const handleKeyPress = (e: React.KeyboardEvent) => { if (e.key === "Enter" && !e.shiftKey) { e.preventDefault(); handleSend(); } };
@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { Copy, Gift, Coins, Trophy, X, Share2, Sparkles } from "lucide-react";
 import { supabase } from "../lib/supabase";
 import axios from "axios";
@@ -12,6 +12,8 @@ interface Props {
 export default function GamifiedReferral({ userId, referralCode, onClose }: Props) {
     const [coins, setCoins] = useState(0);
     const [loading, setLoading] = useState(false);
+    // Mesma chave enquanto o resgate não tiver resposta do servidor (reenvio não resgata duas vezes)
+    const idempotencyKeyRef = useRef<string | null>(null);
 
     useEffect(() => {
         fetchCoins();
@@ -35,10 +37,13 @@ export default function GamifiedReferral({ userId, referralCode, onClose }: Prop
         try {
             const formData = new FormData();
             formData.append("user_id", userId);
-            await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/redeem-coins`, formData);
+            if (!idempotencyKeyRef.current) idempotencyKeyRef.current = crypto.randomUUID();
+            await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/redeem-coins`, formData, { headers: { "Idempotency-Key": idempotencyKeyRef.current } });
+            idempotencyKeyRef.current = null;
             alert("SUCESSO! Você agora é membro PLUS! 🎉");
             window.location.reload();
-        } catch (e) {
+        } catch (e: any) {
+            if (e.response) idempotencyKeyRef.current = null;
             alert("Erro ao resgatar. Tente novamente.");
         } finally {
             setLoading(false);
@@ -1,6 +1,6 @@
 "use client";
 
-import React, { useState } from "react";
+import React, { useState, useRef, useEffect } from "react";
 import axios from "axios";
 import { X, Check, CreditCard, Gift, Share2, Copy, Loader2, Crown, Zap, Link as LinkIcon } from "lucide-react";
 
@@ -23,6 +23,9 @@ export default function StoreModal({ userId, currentPlan, referralCode, onClose,
     const [couponCode, setCouponCode] = useState("");
     const [loading, setLoading] = useState(false);
     const [message, setMessage] = useState<{ type: 'success' | 'error', text: string } | null>(null);
+    // Mesma chave para reenvios do mesmo cupom enquanto o servidor não responder
+    const idempotencyKeyRef = useRef<string | null>(null);
+    useEffect(() => { idempotencyKeyRef.current = null; }, [couponCode]);
 
     const PRODUCTS = [
         { id: "free", type: "plan", name: "Free", credits: 100, price: "R$ 0", features: ["100 Créditos/mês", "Com Marca d'água", "Acesso Básico"] },
@@ -36,10 +39,13 @@ export default function StoreModal({ userId, currentPlan, referralCode, onClose,
         setLoading(true);
         setMessage(null);
         try {
-            await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/redeem-coupon`, { user_id: userId, code: couponCode });
+            if (!idempotencyKeyRef.current) idempotencyKeyRef.current = crypto.randomUUID();
+            await axios.post(`${process.env.NEXT_PUBLIC_API_URL}/redeem-coupon`, { user_id: userId, code: couponCode }, { headers: { "Idempotency-Key": idempotencyKeyRef.current } });
+            idempotencyKeyRef.current = null;
             setMessage({ type: "success", text: "Sucesso! Créditos adicionados." });
             onUpdate(); setCouponCode("");
         } catch (error: any) {
+            if (error.response) idempotencyKeyRef.current = null;
             setMessage({ type: "error", text: error.response?.data?.detail || "Inválido." });
         } finally { setLoading(false); }
     };